@@ -0,0 +1,314 @@
+# loadtest.py
+"""
+End-to-end load test for the bot without touching the real services.
+
+Starts two local stand-ins:
+- a fake Pollinations server (in its own process) with a log-normal latency
+  distribution, a configurable error rate and configurable image sizes
+- a fake Telegram Bot API that records every call and answers a share of
+  them with 429 Too Many Requests
+
+then runs the real bot from main.py against them and replays the full setup
+conversation (prompt -> negative prompt -> timeout -> number -> quality ->
+ratio -> style -> output type) for many simulated users. Reports
+time-to-first-image percentiles, jobs/sec, the peak RSS of the bot process
+and the callbacks that blocked the event loop. With --max-loop-stalls the
+exit status fails a CI run that blocks the loop more often than allowed.
+
+Usage: python loadtest.py --users 1000 --concurrency 200
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from io import BytesIO
+
+import tornado.httputil
+import tornado.netutil
+import tornado.web
+from telegram import Update
+from tornado.httpserver import HTTPServer
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+REPLY_TIMEOUT = 300 # Seconds a simulated user waits for any answer before giving up
+
+# --- Fake Pollinations ---
+
+def make_image_payload(pixels, payload_kb) -> bytes:
+    """A real JPEG when Pillow is available (so post-processing has work to do), random bytes otherwise."""
+    if Image is not None:
+        output = BytesIO()
+        Image.effect_noise((pixels, pixels), 32).convert("RGB").save(output, format="JPEG", quality=90)
+        return output.getvalue()
+    return os.urandom(payload_kb * 1024)
+
+class FakeImageHandler(tornado.web.RequestHandler):
+    def initialize(self, options, payload):
+        self.options = options
+        self.payload = payload
+
+    async def get(self, prompt):
+        latency = random.lognormvariate(math.log(self.options.latency_median), self.options.latency_sigma)
+        await asyncio.sleep(latency)
+        if random.random() < self.options.error_rate:
+            self.set_status(500)
+            return
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(self.payload)
+
+def run_fake_pollinations(options, port_queue) -> None:
+    """Entry point of the fake Pollinations process."""
+    logging.getLogger("tornado.access").setLevel(logging.ERROR) # Served errors are intended
+
+    async def serve():
+        payload = make_image_payload(options.image_pixels, options.payload_kb)
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        server = HTTPServer(tornado.web.Application([
+            (r"/prompt/(.*)", FakeImageHandler, dict(options=options, payload=payload)),
+        ]))
+        server.add_sockets(sockets)
+        port_queue.put((sockets[0].getsockname()[1], len(payload)))
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+# --- Fake Telegram Bot API ---
+
+class FakeTelegram:
+    """Answers Bot API calls like Telegram would and hands every call for a chat to the waiting user."""
+
+    def __init__(self, rate_limit_share):
+        self.rate_limit_share = rate_limit_share
+        self.calls = Counter() # method -> number of calls
+        self.rate_limited = 0
+        self._message_ids = itertools.count(1)
+        self._replies = defaultdict(asyncio.Queue) # chat_id -> (method, params) of calls into the chat
+        self.last_message_id = {} # chat_id -> id of the last message sent into the chat
+
+    def _message(self, chat_id, params, photo=False):
+        message_id = next(self._message_ids)
+        self.last_message_id[chat_id] = message_id
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "LoadTest"},
+        }
+        if photo:
+            message["photo"] = [{"file_id": f"photo-{message_id}", "file_unique_id": f"u{message_id}", "width": 1280, "height": 1280}]
+        else:
+            message["text"] = params.get("text", "")
+        return message
+
+    def handle(self, method, params):
+        """Returns (HTTP status, response body) for a call."""
+        self.calls[method] += 1
+        if method != "getMe" and random.random() < self.rate_limit_share:
+            self.rate_limited += 1
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}}
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "load_test_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, params)
+        elif method == "sendPhoto":
+            result = self._message(chat_id, params, photo=True)
+        elif method == "sendMediaGroup":
+            result = [self._message(chat_id, params, photo=True) for _ in json.loads(params["media"])]
+        else:
+            result = True
+        if chat_id is not None:
+            self._replies[chat_id].put_nowait((method, params))
+        return 200, {"ok": True, "result": result}
+
+    async def next_call(self, chat_id):
+        """Waits for the bot's next call into the chat and returns (method, params)."""
+        return await asyncio.wait_for(self._replies[chat_id].get(), REPLY_TIMEOUT)
+
+class FakeTelegramHandler(tornado.web.RequestHandler):
+    def initialize(self, fake):
+        self.fake = fake
+
+    async def post(self, method):
+        arguments, files = {}, {}
+        tornado.httputil.parse_body_arguments(self.request.headers.get("Content-Type", ""), self.request.body, arguments, files)
+        params = {name: values[0].decode() for name, values in arguments.items()}
+        status, body = self.fake.handle(method, params)
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(body))
+
+# --- Driver ---
+
+def percentile(values, percent):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+class Driver:
+    """Feeds scripted conversations into the bot's update queue and measures the results."""
+
+    def __init__(self, options, application, telegram):
+        self.options = options
+        self.application = application
+        self.telegram = telegram
+        self._update_ids = itertools.count(1)
+        self.time_to_first_image = []
+        self.completed_jobs = 0
+        self.failed_users = 0
+
+    def _user(self, chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+
+    async def _send_text(self, chat_id, text):
+        update_id = next(self._update_ids)
+        data = {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"}, "from": self._user(chat_id),
+        }}
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    async def _press(self, chat_id, callback_data):
+        update_id = next(self._update_ids)
+        data = {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self._user(chat_id), "chat_instance": str(chat_id), "data": callback_data,
+            "message": {
+                "message_id": self.telegram.last_message_id.get(chat_id, 1), "date": int(time.time()), "text": "",
+                "chat": {"id": chat_id, "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "LoadTest"},
+            },
+        }}
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    async def simulate_user(self, user_index):
+        import main
+        chat_id = 100000 + user_index
+        prompt = f"load test prompt {user_index % self.options.unique_prompts}"
+        steps = [
+            (self._send_text, prompt),
+            (self._press, "skip_negative_prompt"),
+            (self._press, "use_default_timeout"),
+            (self._press, f"num_{self.options.images}"),
+            (self._press, f"quality_{random.choice(list(main.QUALITIES))}"),
+            (self._press, f"ratio_{random.choice(list(main.RATIOS))}"),
+            (self._press, f"style_{random.choice(main.STYLES)}"),
+        ]
+        try:
+            for send, payload in steps:
+                await send(chat_id, payload)
+                await self.telegram.next_call(chat_id) # Wait for the bot's answer like a user would
+                await asyncio.sleep(self.options.think_time)
+            started_at = time.monotonic()
+            await self._press(chat_id, "output_images")
+            first_image_seen = False
+            while True:
+                method, params = await self.telegram.next_call(chat_id)
+                if method in ("sendPhoto", "sendMediaGroup") and not first_image_seen:
+                    self.time_to_first_image.append(time.monotonic() - started_at)
+                    first_image_seen = True
+                if method == "sendMessage" and params.get("text", "").startswith(("All done", "No images could be generated")):
+                    self.completed_jobs += 1
+                    return
+        except asyncio.TimeoutError:
+            self.failed_users += 1
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.options.concurrency)
+
+        async def limited(user_index):
+            async with semaphore:
+                await self.simulate_user(user_index)
+
+        await asyncio.gather(*(limited(user_index) for user_index in range(self.options.users)))
+
+async def run_load_test(options, pollinations_port, telegram):
+    import main
+    main.POLLINATIONS_IMAGE_API = f"http://127.0.0.1:{pollinations_port}/prompt/"
+    main.TELEGRAM_GLOBAL_REQUESTS_PER_SECOND = options.telegram_rps
+    main.METRICS_PORT = options.metrics_port
+
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = HTTPServer(tornado.web.Application([(r"/bot[^/]+/(\w+)", FakeTelegramHandler, dict(fake=telegram))]))
+    server.add_sockets(sockets)
+    main.TELEGRAM_API_BASE_URL = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/bot"
+
+    application = main.build_application(receive_updates=False)
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        driver = Driver(options, application, telegram)
+        started_at = time.monotonic()
+        await driver.run()
+        elapsed = time.monotonic() - started_at
+        await application.stop()
+    await application.post_shutdown(application)
+    server.stop()
+    return driver, elapsed
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="simulated users, each running one conversation")
+    parser.add_argument("--concurrency", type=int, default=100, help="users in a conversation at the same time")
+    parser.add_argument("--images", type=int, default=4, help="images each user asks for")
+    parser.add_argument("--unique-prompts", type=int, default=10**9, help="distinct prompts; lower it to exercise caching and coalescing")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a user waits before answering")
+    parser.add_argument("--latency-median", type=float, default=2.0, help="median Pollinations latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="sigma of the log-normal Pollinations latency")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="share of Pollinations requests answered with HTTP 500")
+    parser.add_argument("--image-pixels", type=int, default=1024, help="side length of the served images (needs Pillow)")
+    parser.add_argument("--payload-kb", type=int, default=300, help="size of the served images without Pillow")
+    parser.add_argument("--telegram-429-rate", type=float, default=0.01, help="share of Bot API calls answered with 429")
+    parser.add_argument("--telegram-rps", type=float, default=30, help="bot's global Telegram request rate")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve the bot's /metrics on this port during the run")
+    parser.add_argument("--max-loop-stalls", type=int, default=None, help="exit with status 1 if the event loop stalls more often")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    options = parser.parse_args()
+
+    # Fresh cache, database and job queue for every run
+    os.chdir(tempfile.mkdtemp(prefix="loadtest-"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    port_queue = multiprocessing.get_context("spawn").Queue()
+    pollinations = multiprocessing.get_context("spawn").Process(target=run_fake_pollinations, args=(options, port_queue), daemon=True)
+    pollinations.start()
+    pollinations_port, payload_size = port_queue.get()
+
+    import main # Only now, so its cache and database end up in the temporary directory
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.ERROR) # Retries and 429s are expected; keep the report readable
+
+    telegram = FakeTelegram(options.telegram_429_rate)
+    try:
+        driver, elapsed = asyncio.run(run_load_test(options, pollinations_port, telegram))
+    finally:
+        pollinations.terminate()
+
+    ttfi = driver.time_to_first_image
+    print(f"Users: {options.users} ({options.concurrency} concurrent), {options.images} images each, payload {payload_size // 1024} KB")
+    print(f"Completed jobs: {driver.completed_jobs}, users timed out: {driver.failed_users}, wall time {elapsed:.1f}s")
+    print(f"Jobs/sec: {driver.completed_jobs / elapsed:.2f}")
+    print(f"Time to first image: p50 {percentile(ttfi, 50):.2f}s, p95 {percentile(ttfi, 95):.2f}s, p99 {percentile(ttfi, 99):.2f}s")
+    print(f"Telegram calls: {dict(telegram.calls)}, answered with 429: {telegram.rate_limited}")
+    print(f"Peak RSS of the bot process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB (includes the fake Telegram API)")
+    stalls = {labels["handler"]: count for _, labels, count in main.LOOP_STALLS.samples()}
+    worst = ", ".join(f"{handler} {count}" for handler, count in sorted(stalls.items(), key=lambda item: -item[1])[:5])
+    print(f"Event loop stalls over {main.SLOW_CALLBACK_THRESHOLD * 1000:.0f}ms: {sum(stalls.values())}{f' ({worst})' if worst else ''}")
+    if options.max_loop_stalls is not None and sum(stalls.values()) > options.max_loop_stalls:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,6 +1,8 @@
 # main.py
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto
+from telegram.error import RetryAfter
+from telegram.ext import BasePersistence, BaseRateLimiter, BaseUpdateProcessor, CallbackContext, PersistenceInput
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -8,13 +10,40 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ConversationHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
-import requests
+import httpx
 import urllib.parse
 from io import BytesIO
 import asyncio # For the progress animation
-import json # For saving/loading settings in user_data
+import json # For persisting user_data and conversation states
+import bisect
+import concurrent.futures
+import contextvars
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import os
+import random
+import secrets
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+try:
+    from PIL import Image # Optional, enables image post-processing
+except ImportError:
+    Image = None
 
 # Configure logging
 logging.basicConfig(
@@ -24,12 +53,128 @@ logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 TELEGRAM_BOT_TOKEN = "7582238839:AAHcJW1kOcEcJ_RRk5ovZVmvebxE4za9x7I"
+TELEGRAM_API_BASE_URL = "https://api.telegram.org/bot" # Bot API endpoint (loadtest.py points it at a local stand-in)
 POLLINATIONS_IMAGE_API = "https://image.pollinations.ai/prompt/"
 MAX_RECENT_PROMPTS = 5 # Maximum number of recent prompts to store
 DEFAULT_IMAGE_TIMEOUT = 60 # Default timeout for image generation requests in seconds
 
+# Shared HTTP connection pool used for all Pollinations requests
+HTTP_MAX_CONNECTIONS = 32 # Upper bound on open connections to Pollinations
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16 # Idle connections kept around for reuse
+HTTP_KEEPALIVE_EXPIRY = 30 # Seconds an idle keep-alive connection stays open
+HTTP_CONNECT_TIMEOUT = 10 # Seconds allowed for establishing a connection
+IMAGE_MAX_BYTES = 10 * 1024 * 1024 # Largest image accepted from Pollinations (Telegram's photo upload limit)
+IMAGE_SPOOL_THRESHOLD = 1024 * 1024 # Downloads larger than this spill from memory to a temp file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 # Bytes read from the network at a time
+# Pollinations health tracking, circuit breaker and adaptive timeouts
+BREAKER_WINDOW = 50 # Recent requests used to compute the error rate
+BREAKER_MIN_REQUESTS = 10 # Requests needed in the window before the breaker can trip
+BREAKER_ERROR_RATE = 0.5 # Error rate that trips the breaker
+BREAKER_OPEN_SECONDS = 30 # How long requests fail fast before a probe is let through
+LATENCY_WINDOW = 200 # Recent successful requests used for latency percentiles
+ADAPTIVE_TIMEOUT_FACTOR = 2.0 # Timeout is this multiple of the observed p95 latency
+ADAPTIVE_TIMEOUT_MIN = 15 # Adaptive timeouts never go below this many seconds
+# Retries and hedged requests for image fetches
+FETCH_MAX_ATTEMPTS = 3 # Attempts per image, all within the user's timeout
+RETRY_BASE_BACKOFF = 1.0 # Seconds; doubled for each further attempt
+RETRY_MAX_BACKOFF = 8.0 # Upper bound for a single backoff
+RETRY_MIN_REMAINING = 5 # Don't start another attempt with less time left than this
+HEDGE_REQUESTS = True # Send a duplicate request when the first one is unusually slow
+HEDGE_LATENCY_PERCENTILE = 90 # A request is "slow" once it runs longer than this percentile
+HEDGE_MIN_DELAY = 5 # Never hedge earlier than this many seconds
+HEDGE_MAX_LOAD = 0.5 # Only hedge while fewer than this share of global fetch slots is in use
+MAX_PARALLEL_FETCHES_PER_REQUEST = 4 # Variants of one request fetched at the same time
+
+# Global generation scheduler limits
+MAX_GLOBAL_FETCHES = 16 # Image fetches in flight across all users
+MAX_FETCHES_PER_USER = 4 # Image fetches in flight for a single user
+MAX_ACTIVE_JOBS_PER_USER = 2 # Generation requests a user may have running at once
+QUEUE_POSITION_UPDATE_INTERVAL = 2 # Seconds between queue position checks
+SPECULATIVE_PREFETCH = False # Start fetching likely images before the user confirms the last question
+MAX_SPECULATIVE_FETCHES = 4 # Speculative fetches in flight across all users (they never delay real ones)
+
+# Outbound Telegram API limits (see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+TELEGRAM_GLOBAL_REQUESTS_PER_SECOND = 30 # Requests per second across all chats
+TELEGRAM_CHAT_REQUESTS_PER_SECOND = 1 # Sustained requests per second into one private chat
+TELEGRAM_CHAT_BURST = 3 # Short bursts allowed into one private chat
+TELEGRAM_GROUP_REQUESTS_PER_MINUTE = 20 # Requests per minute into one group or channel
+TELEGRAM_MAX_RETRIES = 3 # Times a request is retried after a RetryAfter (429) response
+TELEGRAM_MEDIA_GROUP_LIMIT = 10 # Most items Telegram accepts in one media group
+
+# Priorities for outbound requests (lower is sent first); passed as rate_limit_args
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 1, 2, 3
+
+# Progress message edits (Telegram allows roughly one message per second per chat)
+PROGRESS_MIN_EDIT_INTERVAL = 1.5 # Seconds between progress edits in the same chat
+PROGRESS_GLOBAL_EDITS_PER_SECOND = 10 # Progress edits per second across all chats
+
+# Result cache for identical generation parameters
+CACHE_DIR = "image_cache" # Directory for the on-disk cache tier
+CACHE_MEMORY_MAX_BYTES = 64 * 1024 * 1024 # In-memory LRU tier size
+CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024 # On-disk tier size
+CACHE_MEMORY_TTL = 60 * 60 # Seconds an image stays valid in memory
+CACHE_DISK_TTL = 24 * 60 * 60 # Seconds an image stays valid on disk
+URL_MODE_WARMUP = True # Ask Pollinations to render images behind sent URLs in the background
+URL_WARMUP_CONCURRENCY = 8 # Warm-up requests in flight across all users
+FILE_ID_INDEX_MAX_ENTRIES = 50000 # Telegram file_ids remembered for already uploaded images
+
+# Image worker processes
+IMAGE_WORKER_PROCESSES = 0 # Fetch images in this many separate processes (0 = in the bot process)
+
+# Image post-processing (needs Pillow, skipped without it)
+POSTPROCESS_IMAGES = True # Re-encode images before upload; Telegram recompresses photos anyway
+POSTPROCESS_PROCESSES = 0 # Re-encode images in this many separate processes (0 = in a thread of the bot process)
+POSTPROCESS_MAX_DIMENSION = 1280 # Longer side of uploaded photos, the largest size Telegram displays
+POSTPROCESS_MAX_BYTES = 512 * 1024 # Upload size cap; JPEG quality is lowered until the photo fits
+POSTPROCESS_JPEG_QUALITY = 90 # First JPEG quality tried
+POSTPROCESS_MIN_JPEG_QUALITY = 50 # Lowest JPEG quality tried before giving up on the size cap
+PREVIEW_THUMBNAIL_SIZE = 320 # Longer side of preview thumbnails (Telegram's maximum)
+SEND_ORIGINALS_AS_DOCUMENTS = False # Also send Pollinations' unmodified files as documents
+PROGRESSIVE_DELIVERY = True # Send each image as soon as it's ready instead of all at the end
+
+# Metrics
+METRICS_LISTEN = "127.0.0.1" # Address of the Prometheus metrics endpoint
+METRICS_PORT = 9464 # Port of the metrics endpoint, plus the shard index when sharded (0 = disabled)
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120) # Histogram buckets in seconds
+
+# Tracing and profiling
+TRACE_LOG_FILE = "generation_traces.jsonl" # Span timings of every generation job, one JSON object per line ("" = disabled)
+ADMIN_USER_IDS = set() # Telegram user IDs allowed to use /profile
+PROFILE_DEFAULT_SECONDS = 30 # Profiling duration for SIGUSR1 and /profile without an argument
+PROFILE_MAX_SECONDS = 300 # Longest profiling run /profile accepts
+PROFILE_SAMPLE_INTERVAL = 0.005 # Seconds between stack samples of the event loop thread
+PROFILE_DIR = "profiles" # Directory profiling reports are written to
+LOOP_LAG_INTERVAL = 0.05 # Seconds between event-loop lag probes
+LOOP_WATCHDOG = True # Continuously measure event-loop lag and report code that blocks the loop
+LOOP_WATCHDOG_INTERVAL = 0.1 # Seconds between watchdog heartbeats
+SLOW_CALLBACK_THRESHOLD = 0.25 # Report a callback that blocks the event loop for longer than this many seconds
+
+# Update delivery
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY] # The only update types the bot handles
+WEBHOOK_URL = "" # Public HTTPS URL for updates, e.g. "https://bot.example.com/telegram" (empty = long polling)
+WEBHOOK_LISTEN = "127.0.0.1" # Address the embedded web server binds to, usually behind a reverse proxy
+WEBHOOK_PORT = 8443 # Port the embedded web server listens on
+WEBHOOK_PATH = "telegram" # URL path updates are accepted on; must match the path of WEBHOOK_URL
+WEBHOOK_SECRET_TOKEN = "" # Telegram sends this with every update; a random one is generated when empty
+WEBHOOK_MAX_CONNECTIONS = 40 # Simultaneous connections Telegram may open to the webhook
+CONCURRENT_UPDATES = 64 # Updates processed at the same time in webhook mode (one at a time per chat)
+
+# Sharding
+SHARD_COUNT = 1 # Bot processes that each own a share of the users (1 = no sharding)
+SHARD_VIRTUAL_NODES = 100 # Points per shard on the consistent hash ring
+SHARD_SOCKET_DIR = "shards" # Directory for the Unix sockets the ingress forwards updates through
+SHARD_CONNECT_TIMEOUT = 30 # Seconds the ingress waits for a starting shard to accept connections
+SHARD_QUEUE_MAX_UPDATES = 1000 # Updates held per unreachable shard before newer ones are dropped
+SHARD_MONITOR_INTERVAL = 1 # Seconds between checks that every shard process is still running
+
 # Define states for our conversation flow
 GET_PROMPT, ASK_NEGATIVE_PROMPT, ASK_CUSTOM_TIMEOUT, RECEIVE_CUSTOM_TIMEOUT, CHOOSE_NUM_IMAGES, CHOOSE_QUALITY, CHOOSE_RATIO, CHOOSE_STYLE, ASK_OUTPUT_TYPE, GET_FEEDBACK_TEXT = range(10)
+CONVERSATION_STATE_NAMES = {
+    GET_PROMPT: "get_prompt", ASK_NEGATIVE_PROMPT: "ask_negative_prompt", ASK_CUSTOM_TIMEOUT: "ask_custom_timeout",
+    RECEIVE_CUSTOM_TIMEOUT: "receive_custom_timeout", CHOOSE_NUM_IMAGES: "choose_num_images",
+    CHOOSE_QUALITY: "choose_quality", CHOOSE_RATIO: "choose_ratio", CHOOSE_STYLE: "choose_style",
+    ASK_OUTPUT_TYPE: "ask_output_type", GET_FEEDBACK_TEXT: "get_feedback_text",
+} # Used as metric labels
 
 # Image Quality/Resolution options (width, height)
 QUALITIES = {
@@ -57,6 +202,13 @@ STYLES = [
 # Number of image options to present to the user
 NUM_IMAGE_OPTIONS = [1, 2, 3, 4, 5, 6, 7, 8]
 
+# Persistence of user_data and conversation state
+PERSISTENCE_DB_PATH = "bot_data.sqlite3" # SQLite database file
+PERSISTENCE_UPDATE_INTERVAL = 10 # Seconds between the application's persistence updates
+PERSISTENCE_FLUSH_DELAY = 2 # Seconds writes are collected before they go to disk in one transaction
+USER_DATA_IDLE_SECONDS = 30 * 60 # Users inactive this long are dropped from memory (still on disk)
+USER_DATA_EVICTION_INTERVAL = 5 * 60 # Seconds between checks for idle users
+
 # --- Helper Functions ---
 def get_progress_bar(current, total, bar_length=20):
     """Generates a text-based progress bar."""
@@ -65,6 +217,2052 @@ def get_progress_bar(current, total, bar_length=20):
     spaces = ' ' * (bar_length - len(arrow))
     return f"[{arrow}{spaces}] {int(progress * 100)}%"
 
+def resolve_generation_parameters(settings):
+    """Returns the full prompt, width and height for a user's generation settings."""
+    base_width, base_height = QUALITIES.get(settings.get('quality'), (1024, 1024))
+    ratio_w, ratio_h = RATIOS.get(settings.get('ratio'), (1, 1))
+
+    # Calculate actual width and height based on quality and aspect ratio
+    if ratio_w >= ratio_h:
+        width = base_width
+        height = int(base_width * (ratio_h / ratio_w))
+    else:
+        height = base_height
+        width = int(base_height * (ratio_w / ratio_h))
+
+    full_prompt = f"{settings.get('prompt')}, {settings['style']} style"
+    negative_prompt = settings.get('negative_prompt', "")
+    if negative_prompt:
+        full_prompt += f", no {negative_prompt}"
+    return full_prompt, width, height
+
+# --- Metrics ---
+
+class Counter:
+    """Prometheus counter; label values are passed positionally in the order of labelnames."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount=1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+class Histogram:
+    """Prometheus histogram with fixed buckets."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self.buckets = tuple(buckets)
+        self._values = {} # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labels) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets): # Values above the last bucket only count towards +Inf
+            entry[index] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def samples(self):
+        for labels, entry in self._values.items():
+            label_dict = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield f"{self.name}_bucket", {**label_dict, "le": str(bound)}, cumulative
+            yield f"{self.name}_bucket", {**label_dict, "le": "+Inf"}, entry[-1]
+            yield f"{self.name}_sum", label_dict, entry[-2]
+            yield f"{self.name}_count", label_dict, entry[-1]
+
+class Gauge:
+    """Prometheus gauge whose value is read from a function at scrape time, so it costs nothing in between."""
+
+    def __init__(self, name, documentation, read):
+        self.name, self.documentation, self.read = name, documentation, read
+
+    def samples(self):
+        yield self.name, {}, self.read()
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        kinds = {Counter: "counter", Histogram: "histogram", Gauge: "gauge"}
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {kinds[type(metric)]}")
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.register(Histogram(
+    "generation_stage_seconds", "Time spent per image in each stage of a generation job", ("stage",)
+))
+IMAGE_SOURCES = metrics.register(Counter(
+    "generation_image_source_total", "Where the images of generation jobs came from", ("source",)
+))
+GENERATION_ERRORS = metrics.register(Counter(
+    "generation_errors_total", "Images that could not be generated or sent, by cause", ("kind",)
+))
+GENERATION_JOBS = metrics.register(Counter(
+    "generation_jobs_total", "Finished generation jobs by outcome", ("outcome",)
+))
+TELEGRAM_RATE_LIMITED = metrics.register(Counter(
+    "telegram_rate_limited_total", "Telegram requests answered with 429 Too Many Requests", ("endpoint",)
+))
+CONVERSATION_STATES = metrics.register(Counter(
+    "conversation_state_entries_total", "Times a conversation entered a state; drop-off shows between steps", ("state",)
+))
+
+def count_state_entries(conversation_handler) -> None:
+    """Wraps the callbacks of a ConversationHandler so every state they move to is counted."""
+    def wrap(callback):
+        @functools.wraps(callback)
+        async def counting_callback(update, context):
+            new_state = await callback(update, context)
+            if new_state is not None: # None keeps the current state
+                CONVERSATION_STATES.inc(CONVERSATION_STATE_NAMES.get(new_state, "end"))
+            return new_state
+        return counting_callback
+
+    handlers = [*conversation_handler.entry_points, *conversation_handler.fallbacks]
+    for state_handlers in conversation_handler.states.values():
+        handlers.extend(state_handlers)
+    for handler in handlers:
+        handler.callback = wrap(handler.callback)
+
+# --- Tracing ---
+
+trace_logger = logging.getLogger(f"{__name__}.trace")
+trace_logger.propagate = False # Traces go to their own file, not the console
+trace_logger.setLevel(logging.INFO)
+if TRACE_LOG_FILE:
+    trace_logger.addHandler(logging.FileHandler(TRACE_LOG_FILE, delay=True))
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class JobTrace:
+    """
+    Span timings of one generation job. Tasks started by the job inherit it
+    through a context variable, so stages record their spans without passing
+    it around. Written to the trace log as one JSON line when the job ends.
+    """
+
+    def __init__(self, job):
+        self.trace_id = secrets.token_hex(8)
+        self.attributes = {
+            "job_id": job['job_id'], "user_id": job['user_id'], "chat_id": job['chat_id'],
+            "num_images": job['num_images'], "resumed": bool(job.get('delivered_images')),
+        }
+        self.started_at = time.monotonic()
+        self.spans = []
+
+    def add_span(self, name, started_at, duration, attributes) -> None:
+        self.spans.append({
+            "span": name, "start_ms": round((started_at - self.started_at) * 1000, 1),
+            "duration_ms": round(duration * 1000, 1), **attributes,
+        })
+
+    def finish(self, outcome) -> None:
+        if not trace_logger.handlers:
+            return
+        trace_logger.info(json.dumps({
+            "trace_id": self.trace_id, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "outcome": outcome,
+            "duration_ms": round((time.monotonic() - self.started_at) * 1000, 1),
+            **self.attributes, "spans": self.spans,
+        }))
+
+def record_stage(name, started_at, **attributes) -> None:
+    """Records a finished stage in the metrics and, inside a generation job, its trace."""
+    duration = time.monotonic() - started_at
+    STAGE_SECONDS.observe(duration, name)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started_at, duration, attributes)
+
+@contextmanager
+def stage(name, **attributes):
+    """Times the with block as a stage of a generation job."""
+    started_at = time.monotonic()
+    try:
+        yield
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        record_stage(name, started_at, **attributes)
+
+# --- Profiling ---
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread (the event loop's) from a background
+    thread. Cheap enough to switch on in production for a short while.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {} # Tuple of frames, outermost first -> samples
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> dict:
+        """Stops sampling and returns the collected stacks."""
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+async def measure_loop_lag(duration, interval=LOOP_LAG_INTERVAL):
+    """Returns how late the event loop woke up for each probe during duration seconds."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    lags = []
+    while loop.time() < deadline:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+    return lags
+
+def format_profile_report(stacks, lags, duration) -> str:
+    """Summarizes a profiling run: loop lag percentiles and the functions the loop spent most time in."""
+    total = sum(stacks.values()) or 1
+    own, inclusive = {}, {}
+    for stack, count in stacks.items():
+        if stack:
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+        for function in set(stack):
+            inclusive[function] = inclusive.get(function, 0) + count
+    lags = sorted(lags) or [0.0]
+    lines = [
+        f"Profiled for {duration}s, {total} stack samples, {len(lags)} loop lag probes",
+        f"Event loop lag: p50 {lags[len(lags) // 2] * 1000:.1f}ms, p99 {lags[int(len(lags) * 0.99)] * 1000:.1f}ms, max {lags[-1] * 1000:.1f}ms",
+        "",
+        "Top functions by own time (the loop idling in select() is normal):",
+    ]
+    for function, count in sorted(own.items(), key=lambda item: -item[1])[:15]:
+        lines.append(f"  {count / total:6.1%}  {function}")
+    lines += ["", "Top functions by inclusive time:"]
+    for function, count in sorted(inclusive.items(), key=lambda item: -item[1])[:15]:
+        lines.append(f"  {count / total:6.1%}  {function}")
+    return "\n".join(lines) + "\n"
+
+_profile_task = None
+
+async def run_profile(duration):
+    """
+    Runs the sampling profiler and the loop lag monitor for duration seconds and
+    writes a report plus the collapsed stacks (for flame graph tools) to PROFILE_DIR.
+    Returns the report text and its path.
+    """
+    profiler = SamplingProfiler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+    profiler.start()
+    try:
+        lags = await measure_loop_lag(duration)
+    finally:
+        stacks = await asyncio.to_thread(profiler.stop)
+    report = format_profile_report(stacks, lags, duration)
+    path = os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+
+    def write():
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(f"{path}.txt", "w") as report_file:
+            report_file.write(report)
+        with open(f"{path}.folded", "w") as folded_file:
+            for stack, count in stacks.items():
+                folded_file.write(f"{';'.join(stack)} {count}\n")
+
+    await asyncio.to_thread(write)
+    logger.info(f"Profiling report written to {path}.txt:\n{report}")
+    return report, f"{path}.txt"
+
+def start_profile(duration, on_done=None) -> bool:
+    """Starts a profiling run in the background unless one is running already."""
+    global _profile_task
+    if _profile_task is not None and not _profile_task.done():
+        return False
+
+    async def profile():
+        report, path = await run_profile(duration)
+        if on_done is not None:
+            await on_done(report, path)
+
+    logger.info(f"Profiling the bot for {duration}s")
+    _profile_task = asyncio.create_task(profile()) # Not application.create_task: stop() would wait for it
+    return True
+
+# --- Event Loop Watchdog ---
+
+LOOP_LAG = metrics.register(Histogram(
+    "event_loop_lag_seconds", "How late the watchdog heartbeat woke up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+))
+LOOP_STALLS = metrics.register(Counter(
+    "event_loop_stalls_total", "Callbacks that blocked the event loop longer than SLOW_CALLBACK_THRESHOLD", ("handler",)
+))
+
+class LoopWatchdog:
+    """
+    Measures event-loop lag continuously and names the code that blocks the
+    loop. A heartbeat task ticks on the loop while a thread watches the ticks;
+    once they stop for longer than the threshold the thread grabs the loop
+    thread's stack while it is still blocked, so the report shows the
+    offender rather than whatever happens to run next.
+    """
+
+    wrapper_names = {"counting_callback"} # Wrappers around handlers; the wrapped handler is named instead
+
+    def __init__(self, interval, threshold):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = deque(maxlen=100) # Most recent stall reports, for loadtest.py and debugging
+        self._last_beat = time.monotonic()
+        self._captured = None # (handler, stack) of the stall in progress
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+
+    async def run(self) -> None:
+        """Heartbeat; runs until cancelled."""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        watcher = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        watcher.start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                self._last_beat = now = time.monotonic()
+                lag = max(0.0, now - expected)
+                LOOP_LAG.observe(lag)
+                captured, self._captured = self._captured, None
+                if lag > self.threshold:
+                    self._report(lag, *(captured or ("unknown", None)))
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        # Polls faster than the threshold so a stall is caught while it's still going on
+        while not self._stop.wait(min(self.interval, self.threshold) / 2):
+            stalled_for = time.monotonic() - self._last_beat - self.interval
+            if stalled_for > self.threshold and self._captured is None:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._captured = self._describe(traceback.extract_stack(frame))
+
+    @classmethod
+    def _describe(cls, stack):
+        """Returns the handler a blocked stack belongs to and the stack from the callback the loop is running."""
+        # Everything below the loop's Handle._run is the callback that blocks
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index].name == "_run" and stack[index].filename.endswith(os.path.join("asyncio", "events.py")):
+                stack = stack[index + 1:]
+                break
+        handler = next((
+            entry.name for entry in stack if entry.filename == __file__ and entry.name not in cls.wrapper_names
+        ), None)
+        if handler is None and stack:
+            handler = stack[0].name
+        return handler or "unknown", stack
+
+    def _report(self, lag, handler, stack) -> None:
+        LOOP_STALLS.inc(handler)
+        self.stalls.append({"handler": handler, "seconds": lag, "stack": stack})
+        stack_text = "".join(traceback.format_list(stack)) if stack else "  (stack not captured)\n"
+        logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms by {handler}:\n{stack_text.rstrip()}")
+
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_INTERVAL, SLOW_CALLBACK_THRESHOLD)
+
+async def serve_metrics(reader, writer) -> None:
+    """Answers a single HTTP request with the current metrics."""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip(): # Skip the headers
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else ""
+        if path.split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+# --- Pollinations HTTP Client ---
+
+_http_client = None # Lazily created httpx.AsyncClient shared by all handlers
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared async HTTP client, creating it on first use."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(DEFAULT_IMAGE_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True,
+        )
+    return _http_client
+
+async def close_http_client(application: Application) -> None:
+    """Closes the shared HTTP client when the bot shuts down."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+class InvalidImageError(Exception):
+    """Raised when Pollinations answers with something that isn't an acceptable image."""
+
+class BackendUnavailableError(Exception):
+    """Raised without contacting Pollinations while the circuit breaker is open."""
+
+class BackendHealth:
+    """
+    Tracks latency and error rate of recent Pollinations requests. When too many
+    requests fail, the circuit breaker opens and requests fail fast for
+    BREAKER_OPEN_SECONDS; then a single probe request decides whether it closes
+    again. Timeouts are derived from the observed p95 latency.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW) # True for success, False for failure
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def is_available(self) -> bool:
+        """True if a request would currently be let through (doesn't claim the probe)."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at >= BREAKER_OPEN_SECONDS
+        return not self._probe_in_flight
+
+    def allow_request(self) -> bool:
+        """Claims permission for one request; in half-open state only one probe is allowed."""
+        if not self.is_available():
+            return False
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self, latency=None) -> None:
+        if latency is not None:
+            self._latencies.append(latency)
+        self._outcomes.append(True)
+        if self.state == self.HALF_OPEN:
+            logger.info("Pollinations is responding again, closing circuit breaker")
+            self.state = self.CLOSED
+            self._outcomes.clear()
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._outcomes.append(False)
+        if self.state == self.HALF_OPEN:
+            self._trip()
+        elif self.state == self.CLOSED and len(self._outcomes) >= BREAKER_MIN_REQUESTS and self.error_rate() >= BREAKER_ERROR_RATE:
+            self._trip()
+        self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Gives up a claimed request without an outcome, e.g. when it was cancelled."""
+        self._probe_in_flight = False
+
+    def _trip(self):
+        logger.warning(f"Pollinations error rate is {self.error_rate():.0%}, opening circuit breaker for {BREAKER_OPEN_SECONDS}s")
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def latency_percentile(self, percentile):
+        """Returns the given percentile (0-100) of recent latencies in seconds, or None without data."""
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def adaptive_timeout(self, max_timeout) -> float:
+        """Timeout for the next request: a multiple of p95 latency, capped by the user's timeout."""
+        if len(self._latencies) < BREAKER_MIN_REQUESTS:
+            return max_timeout
+        p95 = self.latency_percentile(95)
+        return min(max_timeout, max(ADAPTIVE_TIMEOUT_MIN, p95 * ADAPTIVE_TIMEOUT_FACTOR))
+
+    def hedge_delay(self):
+        """Seconds after which a duplicate request should be sent, or None without enough data."""
+        if len(self._latencies) < BREAKER_MIN_REQUESTS:
+            return None
+        return max(HEDGE_MIN_DELAY, self.latency_percentile(HEDGE_LATENCY_PERCENTILE))
+
+pollinations_health = BackendHealth()
+
+async def fetch_image(url, timeout=DEFAULT_IMAGE_TIMEOUT):
+    """
+    Streams an image from Pollinations into a spooled temporary file without
+    blocking the event loop. Small images stay in memory, larger ones spill to
+    disk. The returned file is positioned at the start and must be closed by
+    the caller.
+    Raises httpx.TimeoutException on timeout, httpx.HTTPError on other failures,
+    InvalidImageError if the response is not an image or is too large and
+    BackendUnavailableError while the circuit breaker is open.
+    """
+    if not pollinations_health.allow_request():
+        raise BackendUnavailableError("Pollinations circuit breaker is open")
+    client = get_http_client()
+    request_timeout = httpx.Timeout(timeout, connect=min(timeout, HTTP_CONNECT_TIMEOUT))
+    image_file = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_THRESHOLD)
+    started_at = time.monotonic()
+    try:
+        async with client.stream("GET", url, timeout=request_timeout) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type", "")
+            if not content_type.startswith("image/"):
+                raise InvalidImageError(f"Unexpected content type '{content_type}'")
+            if int(response.headers.get("content-length") or 0) > IMAGE_MAX_BYTES:
+                raise InvalidImageError(f"Image is larger than {IMAGE_MAX_BYTES} bytes")
+            received_bytes = 0
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                received_bytes += len(chunk)
+                if received_bytes > IMAGE_MAX_BYTES:
+                    raise InvalidImageError(f"Image is larger than {IMAGE_MAX_BYTES} bytes")
+                image_file.write(chunk)
+    except (httpx.TransportError, httpx.HTTPStatusError) as e:
+        image_file.close()
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500 and e.response.status_code != 429:
+            pollinations_health.record_success() # The backend answered; the request itself was bad
+        else:
+            pollinations_health.record_failure()
+        raise
+    except BaseException:
+        image_file.close()
+        pollinations_health.release_probe()
+        raise
+    pollinations_health.record_success(time.monotonic() - started_at)
+    image_file.seek(0)
+    return image_file
+
+def is_retryable_fetch_error(error) -> bool:
+    """Timeouts, connection problems, 5xx and 429 are worth another attempt; anything else isn't."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError) # Includes httpx.TimeoutException
+
+def has_hedge_capacity() -> bool:
+    """Returns whether few enough fetches are in flight to afford a hedged request."""
+    return generation_scheduler.in_flight() < generation_scheduler.max_in_flight * HEDGE_MAX_LOAD
+
+async def fetch_image_hedged(url, timeout, allow_hedge=None):
+    """
+    Fetches an image, and if it takes longer than the usual tail latency while
+    there is spare capacity, sends a duplicate request and keeps whichever
+    finishes first. allow_hedge overrides the capacity check; worker processes
+    get it from the bot process, whose scheduler knows the load.
+    """
+    hedge_delay = pollinations_health.hedge_delay() if HEDGE_REQUESTS else None
+    if hedge_delay is None or hedge_delay >= timeout:
+        return await fetch_image(url, timeout=timeout)
+
+    tasks = [] # Every request started here; none may outlive this call
+    try:
+        primary = asyncio.create_task(fetch_image(url, timeout=timeout))
+        tasks.append(primary)
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done or not (has_hedge_capacity() if allow_hedge is None else allow_hedge):
+            return await primary
+
+        logger.info(f"Request for {url} is slower than {hedge_delay:.1f}s, sending a hedged request")
+        hedge = asyncio.create_task(fetch_image(url, timeout=timeout - hedge_delay))
+        tasks.append(hedge)
+        pending = {primary, hedge}
+        first_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if winners:
+                for loser in winners[1:]:
+                    loser.result().close()
+                return winners[0].result()
+            first_error = first_error or next(iter(done)).exception()
+        raise first_error
+    finally:
+        # Also reached when the caller is cancelled, e.g. by Stop or a new prompt
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def fetch_image_with_retries(url, time_budget, allow_hedge=None):
+    """
+    Fetches an image, retrying retryable failures with jittered exponential
+    backoff as long as the user's time budget allows another attempt.
+    """
+    deadline = time.monotonic() + time_budget
+    for attempt in range(1, FETCH_MAX_ATTEMPTS + 1):
+        timeout = pollinations_health.adaptive_timeout(deadline - time.monotonic())
+        try:
+            return await fetch_image_hedged(url, timeout, allow_hedge)
+        except Exception as e:
+            if attempt == FETCH_MAX_ATTEMPTS or not is_retryable_fetch_error(e):
+                raise
+            backoff = random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BASE_BACKOFF * 2 ** (attempt - 1)))
+            if deadline - time.monotonic() - backoff < RETRY_MIN_REMAINING:
+                raise # Not enough time left for a meaningful attempt
+            logger.warning(f"Attempt {attempt} for {url} failed ({e!r}), retrying in {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+
+url_warmup_semaphore = asyncio.Semaphore(URL_WARMUP_CONCURRENCY)
+_url_warmup_tasks = set() # Kept so they aren't garbage collected and can be cancelled on shutdown
+
+async def warm_up_image_url(url, timeout=DEFAULT_IMAGE_TIMEOUT) -> None:
+    """
+    Requests an image so Pollinations starts rendering it, but only waits for the
+    response headers. The body is never downloaded.
+    """
+    async with url_warmup_semaphore:
+        if not pollinations_health.is_available():
+            return # Pollinations is down; the user's client will retry when opening the URL
+        try:
+            request_timeout = httpx.Timeout(timeout, connect=min(timeout, HTTP_CONNECT_TIMEOUT))
+            async with get_http_client().stream("GET", url, timeout=request_timeout) as response:
+                if response.is_error:
+                    logger.warning(f"Warm-up for {url} returned HTTP {response.status_code}")
+        except httpx.HTTPError as e:
+            logger.warning(f"Warm-up request for {url} failed: {e}")
+
+def start_url_warmup(url, timeout) -> None:
+    """
+    Starts a best-effort warm-up in the background. Not through application.create_task,
+    whose tasks Application.stop() would wait for.
+    """
+    task = asyncio.create_task(warm_up_image_url(url, timeout))
+    _url_warmup_tasks.add(task)
+    task.add_done_callback(_url_warmup_tasks.discard)
+
+def cancel_url_warmups() -> None:
+    for task in list(_url_warmup_tasks):
+        task.cancel()
+
+def build_image_generation_url(variant_prompt, width, height, seed=None):
+    """Builds the Pollinations URL for a single image variant."""
+    encoded_prompt = urllib.parse.quote(variant_prompt)
+    url = f"{POLLINATIONS_IMAGE_API}{encoded_prompt}?width={width}&height={height}"
+    if seed is not None:
+        url += f"&seed={seed}"
+    return url
+
+def generation_cache_key(variant_prompt, width, height, seed=None):
+    """Returns a stable key for a set of generation parameters."""
+    normalized_prompt = " ".join(variant_prompt.split())
+    params = json.dumps([normalized_prompt, int(width), int(height), seed])
+    return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+# --- Image Worker Processes ---
+
+_image_workers = [] # Started on first use, only when IMAGE_WORKER_PROCESSES > 0
+_postprocess_pool = None # Lazily created process pool, only used when POSTPROCESS_PROCESSES > 0
+
+# Exceptions can't always be pickled across processes (httpx errors carry their
+# request and response), so workers report errors by kind and the front-end
+# process raises the matching exception again
+_IMAGE_WORKER_ERRORS = {
+    "timeout": httpx.TimeoutException,
+    "http": httpx.HTTPError,
+    "invalid": InvalidImageError,
+    "unavailable": BackendUnavailableError,
+}
+
+async def _run_image_worker_job(url, time_budget, allow_hedge):
+    """
+    Fetches an image with retries and hedging inside a worker process and
+    returns (image bytes, latency, None) or (None, None, (error kind, message, backend failed)).
+    allow_hedge comes from the bot process; the worker's own scheduler is always idle.
+    """
+    started_at = time.monotonic()
+    try:
+        image_file = await fetch_image_with_retries(url, time_budget, allow_hedge)
+    except httpx.TimeoutException as e:
+        return None, None, ("timeout", str(e) or "Timed out", True)
+    except httpx.HTTPError as e:
+        return None, None, ("http", str(e), is_retryable_fetch_error(e))
+    except InvalidImageError as e:
+        return None, None, ("invalid", str(e), False)
+    except BackendUnavailableError as e:
+        return None, None, ("unavailable", str(e), True) # The worker's own breaker saw the backend fail
+    with image_file:
+        return image_file.read(), time.monotonic() - started_at, None
+
+def _image_worker_main(connection) -> None:
+    """Worker process entry point: serves fetches for the bot process until the pipe closes."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The front-end process stops the workers on Ctrl+C
+    asyncio.run(_serve_image_worker(connection))
+
+async def _serve_image_worker(connection) -> None:
+    """
+    Runs every fetch request as its own task on the worker's event loop, so one
+    worker has many fetches in flight, like the bot process itself would.
+    """
+    loop = asyncio.get_running_loop()
+    requests = asyncio.Queue()
+    send_lock = threading.Lock()
+    jobs = {} # job id -> task running the fetch
+
+    def read_requests():
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                message = None
+            loop.call_soon_threadsafe(requests.put_nowait, message)
+            if message is None:
+                return
+
+    def send_result(job_id, result):
+        with send_lock:
+            try:
+                connection.send((job_id, result))
+            except OSError:
+                pass # The bot process is gone
+
+    async def run_job(job_id, url, time_budget, allow_hedge):
+        try:
+            result = await _run_image_worker_job(url, time_budget, allow_hedge)
+        except asyncio.CancelledError:
+            return
+        finally:
+            jobs.pop(job_id, None)
+        await asyncio.to_thread(send_result, job_id, result) # Images can be larger than the pipe buffer
+
+    threading.Thread(target=read_requests, daemon=True).start()
+    while (message := await requests.get()) is not None:
+        if message[0] == "fetch":
+            jobs[message[1]] = asyncio.create_task(run_job(*message[1:]))
+        elif message[0] == "cancel" and message[1] in jobs:
+            jobs[message[1]].cancel()
+    for task in list(jobs.values()):
+        task.cancel()
+    await close_http_client(None)
+
+class ImageWorker:
+    """
+    The bot process's end of one worker process. fetch() sends a request down
+    the pipe and waits for its result; a reader thread hands results back to
+    the event loop. Cancelling a fetch cancels it in the worker too.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._jobs = {} # job id -> future waiting for the result
+        self._job_ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._closed = False
+        context = multiprocessing.get_context("spawn") # Don't fork the running event loop and threads
+        self._connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=_image_worker_main, args=(worker_connection,), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        threading.Thread(target=self._read_results, daemon=True).start()
+
+    @property
+    def load(self) -> int:
+        return len(self._jobs)
+
+    def is_alive(self) -> bool:
+        return not self._closed and self.process.is_alive()
+
+    async def fetch(self, url, time_budget, allow_hedge):
+        """Returns the worker's (image bytes, latency, error) for a fetch."""
+        job_id = next(self._job_ids)
+        future = self._loop.create_future()
+        self._jobs[job_id] = future
+        try:
+            if not self._send(("fetch", job_id, url, time_budget, allow_hedge)):
+                return None, None, ("unavailable", "Image worker process exited", False)
+            return await future
+        except asyncio.CancelledError:
+            self._send(("cancel", job_id))
+            raise
+        finally:
+            self._jobs.pop(job_id, None)
+
+    def _send(self, message) -> bool:
+        with self._send_lock:
+            try:
+                self._connection.send(message)
+                return True
+            except OSError:
+                return False
+
+    def _read_results(self) -> None:
+        """Runs in a thread until the worker's end of the pipe closes."""
+        while True:
+            try:
+                job_id, result = self._connection.recv()
+            except (EOFError, OSError):
+                break
+            self._call_soon(self._resolve, job_id, result)
+        self._call_soon(self._fail_pending)
+
+    def _call_soon(self, callback, *args) -> None:
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            pass # The event loop is already closed
+
+    def _resolve(self, job_id, result) -> None:
+        future = self._jobs.get(job_id)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _fail_pending(self) -> None:
+        self._closed = True
+        for future in self._jobs.values():
+            if not future.done():
+                future.set_result((None, None, ("unavailable", "Image worker process exited", False)))
+
+    def stop(self) -> None:
+        self._closed = True
+        self._connection.close()
+        self.process.terminate()
+        self.process.join(timeout=1)
+
+def get_image_worker() -> ImageWorker:
+    """Returns the least busy worker process, starting workers and replacing dead ones as needed."""
+    for worker in [worker for worker in _image_workers if not worker.is_alive()]:
+        logger.warning(f"Image worker process {worker.process.pid} exited, starting a new one")
+        _image_workers.remove(worker)
+        worker.stop()
+    if not _image_workers:
+        logger.info(f"Starting {IMAGE_WORKER_PROCESSES} image worker processes")
+    while len(_image_workers) < IMAGE_WORKER_PROCESSES:
+        _image_workers.append(ImageWorker())
+    return min(_image_workers, key=lambda worker: worker.load)
+
+def get_postprocess_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Returns the post-processing pool, starting its processes on first use."""
+    global _postprocess_pool
+    if _postprocess_pool is None:
+        _postprocess_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=POSTPROCESS_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN),
+        )
+        logger.info(f"Started {POSTPROCESS_PROCESSES} post-processing processes")
+    return _postprocess_pool
+
+def shutdown_image_worker_pool() -> None:
+    """Stops the fetch and post-processing processes; queued jobs are dropped."""
+    global _postprocess_pool
+    while _image_workers:
+        _image_workers.pop().stop()
+    if _postprocess_pool is not None:
+        _postprocess_pool.shutdown(wait=False, cancel_futures=True)
+        _postprocess_pool = None
+
+async def fetch_image_in_worker(url, time_budget):
+    """
+    Fetches an image in a worker process and returns it as an in-memory file.
+    Raises the same exceptions as fetch_image_with_retries.
+    """
+    if not pollinations_health.allow_request():
+        raise BackendUnavailableError("Pollinations circuit breaker is open")
+    try:
+        image_bytes, latency, error = await get_image_worker().fetch(url, time_budget, has_hedge_capacity())
+    except BaseException:
+        pollinations_health.release_probe()
+        raise
+    if error is None:
+        pollinations_health.record_success(latency)
+        return BytesIO(image_bytes)
+    kind, message, backend_failed = error
+    if backend_failed:
+        pollinations_health.record_failure()
+    else:
+        pollinations_health.record_success()
+    raise _IMAGE_WORKER_ERRORS[kind](message)
+
+async def fetch_generation_image(url, time_budget):
+    """Fetches an image for a generation job, in a worker process if the split setup is enabled."""
+    if IMAGE_WORKER_PROCESSES > 0:
+        return await fetch_image_in_worker(url, time_budget)
+    return await fetch_image_with_retries(url, time_budget)
+
+# --- Image Post-Processing ---
+
+def _encode_jpeg(image, quality) -> bytes:
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+def prepare_image_for_upload(image_bytes, with_thumbnail=False):
+    """
+    Re-encodes an image as a JPEG of at most POSTPROCESS_MAX_DIMENSION pixels
+    per side, lowering the quality (and, as a last resort, the size) until it
+    fits POSTPROCESS_MAX_BYTES, and if asked renders a preview thumbnail. Returns (photo bytes, thumbnail bytes or None).
+    CPU-bound, so it must not run on the event loop.
+    """
+    if Image is None or not POSTPROCESS_IMAGES:
+        return image_bytes, None
+    try:
+        with Image.open(BytesIO(image_bytes)) as source:
+            image = source.convert("RGB") # JPEG has no alpha channel
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning(f"Could not decode image for post-processing, sending it unchanged: {e}")
+        return image_bytes, None
+    original_size = image.size
+    max_dimension = POSTPROCESS_MAX_DIMENSION
+    while True:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS) # Only ever shrinks
+        for quality in range(POSTPROCESS_JPEG_QUALITY, POSTPROCESS_MIN_JPEG_QUALITY - 1, -10):
+            photo = _encode_jpeg(image, quality)
+            if len(photo) <= POSTPROCESS_MAX_BYTES:
+                break
+        if len(photo) <= POSTPROCESS_MAX_BYTES or max_dimension <= PREVIEW_THUMBNAIL_SIZE:
+            break
+        max_dimension = int(max(image.size) * 0.75) # Still too large even at the lowest quality
+    if image.size == original_size and len(image_bytes) <= len(photo):
+        photo = image_bytes # Re-encoding didn't help
+    if not with_thumbnail:
+        return photo, None
+    image.thumbnail((PREVIEW_THUMBNAIL_SIZE, PREVIEW_THUMBNAIL_SIZE))
+    return photo, _encode_jpeg(image, 80)
+
+async def postprocess_image(image_bytes, with_thumbnail=False):
+    """Runs prepare_image_for_upload in a post-processing process if enabled, otherwise in a thread."""
+    if Image is None or not POSTPROCESS_IMAGES:
+        return image_bytes, None
+    if POSTPROCESS_PROCESSES > 0:
+        return await asyncio.get_running_loop().run_in_executor(
+            get_postprocess_pool(), prepare_image_for_upload, image_bytes, with_thumbnail
+        )
+    return await asyncio.to_thread(prepare_image_for_upload, image_bytes, with_thumbnail)
+
+def image_file_extension(image_bytes) -> str:
+    """Guesses the file extension of an image from its first bytes."""
+    if image_bytes.startswith(b"\x89PNG"):
+        return "png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "webp"
+    return "jpg"
+
+# --- Image Cache ---
+
+class ImageCache:
+    """
+    Two-tier cache of generated image bytes: a size-bounded in-memory LRU in
+    front of a size-bounded directory on disk. Entries expire after a TTL.
+    Disk access runs in a worker thread so it never blocks the event loop.
+    """
+
+    def __init__(self, directory, memory_max_bytes, disk_max_bytes, memory_ttl, disk_ttl):
+        self.directory = directory
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.memory_ttl = memory_ttl
+        self.disk_ttl = disk_ttl
+        self._memory = OrderedDict() # key -> (expires_at, bytes)
+        self._memory_bytes = 0
+        self._disk_index = None # key -> (mtime, size), loaded on first disk access
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock() # Guards the index and byte count; disk methods run in several threads
+
+    async def get(self, key):
+        """Returns a readable file object for the cached image, or None on a miss. The caller closes it."""
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, data = entry
+            if expires_at > time.monotonic():
+                self._memory.move_to_end(key)
+                return BytesIO(data)
+            self._drop_memory(key)
+
+        return await asyncio.to_thread(self._disk_open, key)
+
+    async def put(self, key, image_file):
+        """Stores the contents of image_file under key and rewinds it afterwards."""
+        image_file.seek(0, os.SEEK_END)
+        size = image_file.tell()
+        image_file.seek(0)
+        if size <= IMAGE_SPOOL_THRESHOLD: # Only images small enough to be kept in memory anyway
+            self._memory_put(key, image_file.read())
+            image_file.seek(0)
+        await asyncio.to_thread(self._disk_put, key, image_file, size)
+        image_file.seek(0)
+
+    def _memory_put(self, key, data):
+        if len(data) > self.memory_max_bytes:
+            return
+        self._drop_memory(key)
+        self._memory[key] = (time.monotonic() + self.memory_ttl, data)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            oldest_key = next(iter(self._memory))
+            self._drop_memory(oldest_key)
+
+    def _drop_memory(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[1])
+
+    def _load_disk_index(self):
+        # Called with _disk_lock held
+        if self._disk_index is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._disk_index = {}
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"): # Left over from an interrupted write
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            self._disk_index[entry.name] = (stat.st_mtime, stat.st_size)
+            self._disk_bytes += stat.st_size
+
+    def _disk_open(self, key):
+        with self._disk_lock:
+            self._load_disk_index()
+            meta = self._disk_index.get(key)
+            if meta is None:
+                return None
+            if meta[0] + self.disk_ttl < time.time():
+                self._disk_remove(key)
+                return None
+            try:
+                return open(os.path.join(self.directory, key), "rb")
+            except OSError as e:
+                logger.warning(f"Could not read cached image {key}: {e}")
+                self._disk_remove(key)
+                return None
+
+    def _disk_put(self, key, image_file, size):
+        with self._disk_lock:
+            self._load_disk_index()
+        path = os.path.join(self.directory, key)
+        # The copy runs without the lock; a unique temp file keeps concurrent writers of one key apart
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as f:
+                temp_path = f.name
+                shutil.copyfileobj(image_file, f)
+            with self._disk_lock:
+                os.replace(temp_path, path)
+                self._disk_index_add(key, size)
+        except OSError as e:
+            logger.warning(f"Could not write cached image {key}: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _disk_index_add(self, key, size):
+        # Called with _disk_lock held
+        if key in self._disk_index:
+            self._disk_bytes -= self._disk_index[key][1]
+        self._disk_index[key] = (time.time(), size)
+        self._disk_bytes += size
+        if self._disk_bytes > self.disk_max_bytes:
+            for old_key, _ in sorted(self._disk_index.items(), key=lambda item: item[1][0]):
+                if self._disk_bytes <= self.disk_max_bytes:
+                    break
+                self._disk_remove(old_key)
+
+    def _disk_remove(self, key):
+        # Called with _disk_lock held
+        meta = self._disk_index.pop(key, None)
+        if meta is None:
+            return
+        self._disk_bytes -= meta[1]
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+class TelegramFileIdIndex:
+    """
+    Maps generation cache keys to the Telegram file_id of a photo that was
+    already uploaded, so the same image can be re-sent without uploading it again.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._file_ids = OrderedDict()
+
+    def get(self, key):
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+        return file_id
+
+    def put(self, key, file_id):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_entries:
+            self._file_ids.popitem(last=False)
+
+    def discard(self, key):
+        self._file_ids.pop(key, None)
+
+    def remember_sent_photos(self, keys, messages):
+        """Records the file_ids Telegram returned for a sent media group."""
+        for key, message in zip(keys, messages):
+            if message.photo:
+                self.put(key, message.photo[-1].file_id) # Largest size is last
+
+image_cache = ImageCache(CACHE_DIR, CACHE_MEMORY_MAX_BYTES, CACHE_DISK_MAX_BYTES, CACHE_MEMORY_TTL, CACHE_DISK_TTL)
+telegram_file_ids = TelegramFileIdIndex(FILE_ID_INDEX_MAX_ENTRIES)
+
+# --- Generation Scheduler ---
+
+class GenerationScheduler:
+    """
+    Hands out image fetch slots to users. Enforces a global in-flight cap and a
+    per-user cap, and serves waiting users round-robin so one large request
+    can't starve everyone else.
+    """
+
+    def __init__(self, max_in_flight, max_per_user, max_jobs_per_user, max_speculative=0):
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_speculative = max_speculative
+        self._waiters = {} # user_id -> deque of futures waiting for a slot
+        self._round_robin = deque() # user_ids with waiters, in serving order
+        self._speculative_waiters = deque() # Futures of speculative fetches, served last
+        self._in_flight = 0
+        self._in_flight_per_user = {}
+        self._speculative_in_flight = 0
+        self._active_jobs = {}
+
+    def try_start_job(self, user_id) -> bool:
+        """Registers a new generation job, or returns False if the user is over quota."""
+        if self._active_jobs.get(user_id, 0) >= self.max_jobs_per_user:
+            return False
+        self._active_jobs[user_id] = self._active_jobs.get(user_id, 0) + 1
+        return True
+
+    def finish_job(self, user_id) -> None:
+        """Releases the job registered by try_start_job."""
+        remaining = self._active_jobs.get(user_id, 0) - 1
+        if remaining > 0:
+            self._active_jobs[user_id] = remaining
+        else:
+            self._active_jobs.pop(user_id, None)
+
+    def in_flight(self, user_id=None) -> int:
+        """Returns the number of running fetches, globally or for one user."""
+        if user_id is None:
+            return self._in_flight
+        return self._in_flight_per_user.get(user_id, 0)
+
+    def waiting(self) -> int:
+        """Returns the number of fetches waiting for a slot."""
+        return sum(len(queue) for queue in self._waiters.values())
+
+    def queue_position(self, user_id) -> int:
+        """Returns the user's 1-based position in the waiting line, or 0 if not waiting."""
+        try:
+            return self._round_robin.index(user_id) + 1
+        except ValueError:
+            return 0
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        """Waits for a fetch slot for the user and holds it for the duration of the block."""
+        waiter = asyncio.get_running_loop().create_future()
+        if user_id not in self._waiters:
+            self._waiters[user_id] = deque()
+            self._round_robin.append(user_id)
+        self._waiters[user_id].append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(user_id) # Slot was granted just as we got cancelled
+            else:
+                self._discard_waiter(user_id, waiter)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    @asynccontextmanager
+    async def speculative_slot(self):
+        """
+        Like slot(), for speculative fetches: granted only while no regular fetch
+        can use the slot, and to at most max_speculative fetches at a time.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._speculative_waiters.append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_speculative()
+            elif waiter in self._speculative_waiters:
+                self._speculative_waiters.remove(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self._release_speculative()
+
+    def _release_speculative(self):
+        self._in_flight -= 1
+        self._speculative_in_flight -= 1
+        self._dispatch()
+
+    def _discard_waiter(self, user_id, waiter):
+        queue = self._waiters.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._waiters[user_id]
+            self._round_robin.remove(user_id)
+
+    def _release(self, user_id):
+        self._in_flight -= 1
+        remaining = self._in_flight_per_user.get(user_id, 0) - 1
+        if remaining > 0:
+            self._in_flight_per_user[user_id] = remaining
+        else:
+            self._in_flight_per_user.pop(user_id, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Grants free slots to waiting users in round-robin order."""
+        while self._in_flight < self.max_in_flight:
+            # Users already at their own cap keep their place in line but are passed over
+            user_id = next(
+                (uid for uid in self._round_robin if self._in_flight_per_user.get(uid, 0) < self.max_per_user),
+                None
+            )
+            if user_id is None:
+                break
+            self._round_robin.remove(user_id)
+            queue = self._waiters[user_id]
+            waiter = queue.popleft()
+            if queue:
+                self._round_robin.append(user_id) # Back of the line for their next image
+            else:
+                del self._waiters[user_id]
+            if waiter.cancelled():
+                continue
+            waiter.set_result(None)
+            self._in_flight += 1
+            self._in_flight_per_user[user_id] = self._in_flight_per_user.get(user_id, 0) + 1
+
+        # Leftover capacity goes to speculative fetches
+        while self._in_flight < self.max_in_flight and self._speculative_in_flight < self.max_speculative and self._speculative_waiters:
+            waiter = self._speculative_waiters.popleft()
+            if waiter.cancelled():
+                continue
+            waiter.set_result(None)
+            self._in_flight += 1
+            self._speculative_in_flight += 1
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller starts the
+    work, later callers wait for the same result. The work is only cancelled
+    once every caller has given up on it.
+    """
+
+    def __init__(self):
+        self._calls = {} # key -> [task, number of waiting callers]
+
+    async def run(self, key, work):
+        """Returns the result of work() for key, sharing a call that is already in flight."""
+        entry = self._calls.get(key)
+        if entry is None:
+            entry = [asyncio.create_task(work()), 0]
+            self._calls[key] = entry
+            entry[0].add_done_callback(lambda _, key=key, entry=entry: self._forget(key, entry))
+        else:
+            logger.info(f"Joining an in-flight request for {key}")
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                self._forget(key, entry) # New callers must not join a cancelled call
+                entry[0].cancel()
+
+    def in_flight(self, key) -> bool:
+        """Returns whether a call for key is running, so run() would join it."""
+        return key in self._calls
+
+    def _forget(self, key, entry):
+        if self._calls.get(key) is entry:
+            del self._calls[key]
+
+coalesced_fetches = SingleFlight()
+
+generation_scheduler = GenerationScheduler(MAX_GLOBAL_FETCHES, MAX_FETCHES_PER_USER, MAX_ACTIVE_JOBS_PER_USER, MAX_SPECULATIVE_FETCHES)
+
+# --- Generation Jobs ---
+
+JOB_IMAGE_UPLOADED = "uploaded" # Image was delivered to the chat; fetched images are found in the disk cache on resume
+
+class GenerationJobStore:
+    """
+    Durable record of accepted image generation jobs in SQLite, with a
+    per-image checkpoint. Jobs still present at startup were interrupted by a
+    restart and are resumed without re-fetching or re-sending finished images.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS generation_jobs "
+                "(job_id INTEGER PRIMARY KEY AUTOINCREMENT, params TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS generation_job_images "
+                "(job_id INTEGER NOT NULL, image_num INTEGER NOT NULL, state TEXT NOT NULL, PRIMARY KEY (job_id, image_num))"
+            )
+
+    def _execute(self, statements):
+        with self._db_lock, self._db:
+            cursor = None
+            for sql, params in statements:
+                cursor = self._db.executemany(sql, params) if isinstance(params, list) else self._db.execute(sql, params)
+            return cursor.lastrowid
+
+    async def create(self, job) -> int:
+        """Stores a newly accepted job and returns its id."""
+        return await asyncio.to_thread(
+            self._execute,
+            [("INSERT INTO generation_jobs (params, created_at) VALUES (?, ?)", (json.dumps(job), time.time()))]
+        )
+
+    async def checkpoint(self, job_id, image_nums, state) -> None:
+        """Records the progress of some images of a job."""
+        await asyncio.to_thread(
+            self._execute,
+            [(
+                "INSERT OR REPLACE INTO generation_job_images (job_id, image_num, state) VALUES (?, ?, ?)",
+                [(job_id, image_num, state) for image_num in image_nums]
+            )]
+        )
+
+    async def finish(self, job_id) -> None:
+        """Removes a job that completed, failed for good or was stopped by the user."""
+        await asyncio.to_thread(
+            self._execute,
+            [
+                ("DELETE FROM generation_job_images WHERE job_id = ?", (job_id,)),
+                ("DELETE FROM generation_jobs WHERE job_id = ?", (job_id,)),
+            ]
+        )
+
+    async def load_unfinished(self):
+        """Returns the jobs left over from the previous run, oldest first."""
+        def read():
+            with self._db_lock:
+                jobs = self._db.execute("SELECT job_id, params FROM generation_jobs ORDER BY job_id").fetchall()
+                images = self._db.execute(
+                    "SELECT job_id, image_num FROM generation_job_images WHERE state = ?", (JOB_IMAGE_UPLOADED,)
+                ).fetchall()
+            return jobs, images
+
+        jobs, images = await asyncio.to_thread(read)
+        delivered = {}
+        for job_id, image_num in images:
+            delivered.setdefault(job_id, set()).add(image_num)
+        result = []
+        for job_id, params in jobs:
+            job = json.loads(params)
+            job['job_id'] = job_id
+            job['delivered_images'] = delivered.get(job_id, set())
+            result.append(job)
+        return result
+
+generation_job_store = GenerationJobStore(PERSISTENCE_DB_PATH)
+
+_generation_jobs = {} # chat_id -> set of running generation tasks
+_user_stopped_jobs = weakref.WeakSet() # Tasks cancelled on the user's request (not by a shutdown)
+
+def start_generation_job(application: Application, chat_id, coroutine, update=None) -> asyncio.Task:
+    """Runs a generation coroutine as a background task that can be cancelled per chat."""
+    task = application.create_task(coroutine, update=update)
+    jobs = _generation_jobs.setdefault(chat_id, set())
+    jobs.add(task)
+
+    def forget(finished_task):
+        jobs.discard(finished_task)
+        if not jobs and _generation_jobs.get(chat_id) is jobs:
+            del _generation_jobs[chat_id]
+
+    task.add_done_callback(forget)
+    if not application.running:
+        task.cancel() # Started by an update drained during shutdown; it stays queued for the next start
+    return task
+
+def cancel_generation_jobs(chat_id) -> int:
+    """Cancels all running generation jobs of a chat and returns how many there were."""
+    tasks = [task for task in _generation_jobs.get(chat_id, ()) if not task.done()]
+    for task in tasks:
+        _user_stopped_jobs.add(task)
+        task.cancel()
+    return len(tasks)
+
+def interrupt_generation_jobs() -> int:
+    """Cancels every running generation job for a shutdown. They stay queued and resume on the next start."""
+    tasks = [task for jobs in _generation_jobs.values() for task in jobs if not task.done()]
+    for task in tasks:
+        task.cancel()
+    return len(tasks)
+
+class GenerationApplication(Application):
+    """
+    Application that interrupts running generation jobs when it stops.
+    Application.stop() waits for every task started with create_task, which
+    would hold a shutdown up until all jobs had finished.
+    """
+
+    async def stop(self) -> None:
+        interrupted = interrupt_generation_jobs()
+        if interrupted:
+            logger.info(f"Interrupted {interrupted} generation jobs; they resume on the next start")
+        await super().stop()
+
+# --- Speculative Prefetch ---
+
+class SpeculativePrefetcher:
+    """
+    Fetches the images a user will most likely ask for next into the image
+    cache, using only the scheduler's leftover capacity. A generation job that
+    needs one of these images claims it: a fetch that is already running is
+    awaited, one still waiting for a slot is cancelled and fetched normally.
+    When the user changes course, fetches still waiting are dropped and running
+    ones only finish into the cache.
+    """
+
+    def __init__(self):
+        self._fetches = {} # cache_key -> (chat_id, task)
+        self._started = set() # cache_keys whose fetch holds a slot
+
+    async def start(self, chat_id, full_prompt, num_images, width, height, seed, timeout) -> None:
+        """Starts speculative fetches for the variants of a generation that aren't available yet."""
+        self.abandon(chat_id)
+        if not pollinations_health.is_available():
+            return
+        for current_image_num in range(1, (num_images or 0) + 1):
+            variant_prompt = f"{full_prompt} (variation {current_image_num})"
+            cache_key = generation_cache_key(variant_prompt, width, height, seed)
+            if cache_key in self._fetches or telegram_file_ids.get(cache_key) is not None:
+                continue
+            cached = await image_cache.get(cache_key)
+            if cached is not None:
+                cached.close()
+                continue
+            url = build_image_generation_url(variant_prompt, width, height, seed)
+            task = asyncio.create_task(self._prefetch(url, cache_key, timeout))
+            self._fetches[cache_key] = (chat_id, task)
+            task.add_done_callback(lambda finished_task, key=cache_key: self._forget(key, finished_task))
+
+    async def _prefetch(self, url, cache_key, timeout):
+        async with generation_scheduler.speculative_slot():
+            self._started.add(cache_key)
+            logger.debug(f"Speculatively fetching {url}")
+            image_file = await fetch_generation_image(url, timeout)
+        with image_file:
+            await image_cache.put(cache_key, image_file)
+
+    def _forget(self, cache_key, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Speculative fetch failed: {task.exception()!r}")
+        if self._fetches.get(cache_key, (None, None))[1] is task:
+            del self._fetches[cache_key]
+            self._started.discard(cache_key)
+
+    def claim(self, cache_key):
+        """Returns the running speculative fetch for the key to await, or None to fetch normally."""
+        entry = self._fetches.get(cache_key)
+        if entry is None:
+            return None
+        task = entry[1]
+        if cache_key in self._started:
+            return task
+        task.cancel() # Still queued behind real work; a normal fetch gets a slot sooner
+        return None
+
+    def abandon(self, chat_id) -> None:
+        """Drops the chat's speculative fetches that haven't started yet."""
+        for cache_key, (owner, task) in list(self._fetches.items()):
+            if owner == chat_id and cache_key not in self._started:
+                task.cancel()
+
+speculative_prefetcher = SpeculativePrefetcher()
+
+# --- Telegram Rate Limiting ---
+
+class TokenBucket:
+    """Simple async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def time_until_available(self) -> float:
+        """Returns how many seconds until a token can be taken (0 if one is available now)."""
+        self._refill()
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        """Takes a token if one is available right now."""
+        if self.time_until_available() > 0:
+            return False
+        self._tokens -= 1
+        return True
+
+    def pause(self, seconds) -> None:
+        """Blocks the bucket for `seconds`, e.g. after Telegram answered with RetryAfter."""
+        self._refill()
+        self._tokens = min(self._tokens, 1) - seconds * self.rate
+
+    def is_idle(self) -> bool:
+        """True if the bucket is full again, i.e. it hasn't been used recently."""
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self):
+        """Waits until a token is available and takes it."""
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+# Default priority by Bot API endpoint when a call doesn't pass rate_limit_args
+ENDPOINT_PRIORITIES = {
+    "answerCallbackQuery": PRIORITY_HIGH,
+    "sendMediaGroup": PRIORITY_HIGH,
+    "sendPhoto": PRIORITY_HIGH,
+    "sendMessage": PRIORITY_HIGH,
+    "sendChatAction": PRIORITY_LOW,
+}
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter for every request the bot sends. Requests wait for a token
+    from the global bucket and from their chat's bucket (groups and channels
+    get a slower per-minute bucket), and waiting requests are released in
+    priority order so final results overtake progress edits. RetryAfter
+    responses pause the affected chat and the request is retried.
+    """
+
+    def __init__(self, max_retries=TELEGRAM_MAX_RETRIES, global_rate=TELEGRAM_GLOBAL_REQUESTS_PER_SECOND):
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {} # chat_id -> TokenBucket
+        self._waiting = [] # Sorted list of (priority, sequence, chat_id, future)
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    async def initialize(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_NORMAL)
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = float(e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after)
+                TELEGRAM_RATE_LIMITED.inc(endpoint)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram asked to retry {endpoint} for chat {chat_id} after {retry_after}s (attempt {attempt + 1})")
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global_bucket
+                bucket.pause(retry_after)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0 # Groups, channels and @usernames
+            if is_group:
+                bucket = TokenBucket(TELEGRAM_GROUP_REQUESTS_PER_MINUTE / 60, TELEGRAM_GROUP_REQUESTS_PER_MINUTE)
+            else:
+                bucket = TokenBucket(TELEGRAM_CHAT_REQUESTS_PER_SECOND, TELEGRAM_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, priority, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiting, (priority, next(self._sequence), chat_id, future)) # Sequence is unique, ties never reach the future
+        self._wakeup.set()
+        await future
+
+    async def _dispatch_loop(self):
+        while True:
+            delay = self._grant_ready()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant_ready(self):
+        """
+        Releases waiting requests in priority order while tokens are available.
+        Returns the seconds until another request could go out, or None if nothing waits.
+        """
+        next_delay = None
+        still_waiting = []
+        for index, entry in enumerate(self._waiting):
+            priority, _, chat_id, future = entry
+            if future.done():
+                continue # Caller was cancelled while waiting
+            global_delay = self._global_bucket.time_until_available()
+            if global_delay > 0:
+                # Nothing else can go out either; keep the rest in order
+                still_waiting.extend(e for e in self._waiting[index:] if not e[3].done())
+                next_delay = global_delay if next_delay is None else min(next_delay, global_delay)
+                break
+            chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            if chat_bucket is not None and not chat_bucket.try_acquire():
+                # This chat is busy; requests for other chats may go ahead of it
+                chat_delay = chat_bucket.time_until_available()
+                next_delay = chat_delay if next_delay is None else min(next_delay, chat_delay)
+                still_waiting.append(entry)
+                continue
+            self._global_bucket.try_acquire()
+            future.set_result(None)
+        self._waiting = still_waiting
+        if len(self._chat_buckets) > 10000:
+            for chat_id in [c for c, b in self._chat_buckets.items() if b.is_idle()]:
+                del self._chat_buckets[chat_id]
+        return next_delay
+
+# --- Update Processing ---
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently, but updates of the same
+    chat one after another, so a conversation never handles two of its updates
+    at once.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {} # chat_id -> [asyncio.Lock, number of updates using it]
+
+    async def process_update(self, update, coroutine) -> None:
+        # The chat lock is taken before a concurrency slot, so updates queued
+        # behind a busy chat wait without holding slots other chats could use.
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# --- Progress Reporting ---
+
+progress_edit_bucket = TokenBucket(PROGRESS_GLOBAL_EDITS_PER_SECOND, PROGRESS_GLOBAL_EDITS_PER_SECOND)
+_last_progress_edit_per_chat = {} # chat_id -> time.monotonic() of the last progress edit
+
+class ProgressReporter:
+    """
+    Keeps a progress message up to date without flooding Telegram. Callers
+    push the latest text with update(); edits are coalesced so only the newest
+    text is sent, at most once per PROGRESS_MIN_EDIT_INTERVAL per chat and
+    within the global progress edit budget. Unchanged text is never re-sent.
+    """
+
+    def __init__(self, bot, message, reply_markup=None):
+        self.bot = bot
+        self.chat_id = message.chat_id
+        self.message_id = message.message_id
+        self.reply_markup = reply_markup # Re-sent with every edit, otherwise Telegram drops it
+        self._last_text = getattr(message, "text", None)
+        self._pending_text = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def update(self, text) -> None:
+        """Schedules text to be shown; replaces any text not yet sent."""
+        if text == self._last_text:
+            self._pending_text = None # Whatever was queued is already outdated
+            return
+        self._pending_text = text
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stops reporting and drops any update that hasn't been sent yet."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            wait_time = _last_progress_edit_per_chat.get(self.chat_id, 0) + PROGRESS_MIN_EDIT_INTERVAL - time.monotonic()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time) # Let more updates pile up; only the newest is sent
+            await progress_edit_bucket.acquire()
+            self._wakeup.clear()
+            text, self._pending_text = self._pending_text, None
+            if text is None or text == self._last_text:
+                continue
+            _last_progress_edit_per_chat[self.chat_id] = time.monotonic()
+            try:
+                with stage("progress_edit"):
+                    await self.bot.edit_message_text(
+                        chat_id=self.chat_id,
+                        message_id=self.message_id,
+                        text=text,
+                        reply_markup=self.reply_markup,
+                        rate_limit_args=PRIORITY_LOW # Final results go out before progress edits
+                    )
+                self._last_text = text
+            except RetryAfter as e:
+                logger.warning(f"Progress edits for chat {self.chat_id} are rate limited for {e.retry_after}s")
+                _last_progress_edit_per_chat[self.chat_id] = time.monotonic() + float(e.retry_after)
+                if self._pending_text is None:
+                    self._pending_text = text
+                self._wakeup.set()
+            except Exception as edit_error:
+                logger.warning(f"Could not edit message for progress update: {edit_error}")
+            finally:
+                self._prune_chat_times()
+
+    @staticmethod
+    def _prune_chat_times():
+        # Forget chats whose last edit is long past so the dict doesn't grow forever
+        if len(_last_progress_edit_per_chat) > 10000:
+            cutoff = time.monotonic() - PROGRESS_MIN_EDIT_INTERVAL
+            for chat_id in [c for c, t in _last_progress_edit_per_chat.items() if t < cutoff]:
+                del _last_progress_edit_per_chat[chat_id]
+
+# --- Persistence ---
+
+class SQLitePersistence(BasePersistence):
+    """
+    Stores user_data and ConversationHandler states in SQLite.
+
+    user_data is loaded lazily: nothing is read at startup, and a user's data
+    is fetched the first time one of their updates arrives (via
+    refresh_user_data). Users idle for USER_DATA_IDLE_SECONDS are dropped
+    from memory again, so memory follows active users rather than every user
+    ever seen. Writes are collected for PERSISTENCE_FLUSH_DELAY seconds and
+    committed in a single transaction.
+    """
+
+    def __init__(self, path):
+        super().__init__(
+            store_data=PersistenceInput(user_data=True, chat_data=False, bot_data=False, callback_data=False),
+            update_interval=PERSISTENCE_UPDATE_INTERVAL,
+        )
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock() # Serializes access from worker threads
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations "
+                "(name TEXT NOT NULL, conversation_key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, conversation_key))"
+            )
+        self._loaded_users = set()
+        self._last_seen = {} # user_id -> time.monotonic() of their last update
+        self._evicting = set() # Users being dropped from memory, not from disk
+        self._pending_users = {} # user_id -> serialized data, or None to delete
+        self._pending_conversations = {} # (name, key) -> serialized state, or None to delete
+        self._flush_task = None
+        self._eviction_task = None
+
+    # Loading
+
+    async def get_user_data(self):
+        return {} # Loaded per user in refresh_user_data
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._last_seen[user_id] = time.monotonic()
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        if user_id in self._pending_users:
+            return # Written after eviction but not flushed yet; memory already has newer data
+        stored = await asyncio.to_thread(self._read_user_data, user_id)
+        if stored:
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+    def _read_user_data(self, user_id):
+        with self._db_lock:
+            row = self._db.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def get_conversations(self, name):
+        def read():
+            with self._db_lock:
+                rows = self._db.execute("SELECT conversation_key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+            return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+        return await asyncio.to_thread(read)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # Writing
+
+    async def update_user_data(self, user_id, data):
+        self._pending_users[user_id] = json.dumps(data)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        if user_id in self._evicting:
+            self._evicting.discard(user_id) # Only evicted from memory, keep it on disk
+            return
+        self._last_seen.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(PERSISTENCE_FLUSH_DELAY)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if users or conversations:
+            await asyncio.to_thread(self._write, users, conversations)
+
+    def _write(self, users, conversations):
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                [(user_id, data) for user_id, data in users.items() if data is not None]
+            )
+            self._db.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in users.items() if data is None]
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO conversations (name, conversation_key, state) VALUES (?, ?, ?)",
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+            )
+            self._db.executemany(
+                "DELETE FROM conversations WHERE name = ? AND conversation_key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None]
+            )
+
+    async def flush(self):
+        if self._eviction_task is not None:
+            self._eviction_task.cancel()
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+
+    # Memory management
+
+    def start_eviction(self, application: Application) -> None:
+        """Starts the background task that drops idle users' data from memory."""
+        self._eviction_task = asyncio.create_task(self._evict_idle_users(application))
+
+    async def _evict_idle_users(self, application):
+        while True:
+            await asyncio.sleep(USER_DATA_EVICTION_INTERVAL)
+            # Idle time is far longer than the update interval, so their data is already persisted
+            cutoff = time.monotonic() - USER_DATA_IDLE_SECONDS
+            idle_users = [user_id for user_id, seen in self._last_seen.items() if seen < cutoff]
+            for user_id in idle_users:
+                del self._last_seen[user_id]
+                self._loaded_users.discard(user_id) # An update before PTB persists the drop must reload from disk
+                self._evicting.add(user_id)
+                application.drop_user_data(user_id)
+            if idle_users:
+                logger.info(f"Dropped {len(idle_users)} idle users from memory")
+
+_loop_watchdog_task = None
+
+async def start_background_tasks(application: Application) -> None:
+    """Starts long-running helper tasks once the application is initialized."""
+    global _loop_watchdog_task
+    if isinstance(application.persistence, SQLitePersistence):
+        application.persistence.start_eviction(application)
+    unfinished_jobs = await generation_job_store.load_unfinished()
+    asyncio.create_task(resume_generation_jobs(application, unfinished_jobs))
+    if METRICS_PORT:
+        await start_metrics_server(application)
+    if LOOP_WATCHDOG:
+        _loop_watchdog_task = asyncio.create_task(loop_watchdog.run())
+    if hasattr(signal, "SIGUSR1"): # `kill -USR1 <pid>` profiles a running bot
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, start_profile, PROFILE_DEFAULT_SECONDS
+        )
+
+async def stop_background_tasks(application: Application) -> None:
+    """Releases shared resources after the application has shut down."""
+    cancel_url_warmups()
+    await close_http_client(application)
+    shutdown_image_worker_pool()
+    if _metrics_server is not None:
+        _metrics_server.close()
+    if _loop_watchdog_task is not None:
+        _loop_watchdog_task.cancel()
+
+_metrics_server = None
+
+async def start_metrics_server(application: Application) -> None:
+    """Registers the gauges that read this application's state and serves /metrics."""
+    global _metrics_server
+    metrics.register(Gauge(
+        "generation_jobs_in_flight", "Generation jobs currently running",
+        lambda: sum(len(jobs) for jobs in _generation_jobs.values())
+    ))
+    metrics.register(Gauge(
+        "generation_fetches_in_flight", "Image fetches holding a scheduler slot", generation_scheduler.in_flight
+    ))
+    metrics.register(Gauge(
+        "generation_fetches_queued", "Image fetches waiting for a scheduler slot", generation_scheduler.waiting
+    ))
+    metrics.register(Gauge(
+        "user_data_users", "Users with data held in memory", lambda: len(application.user_data)
+    ))
+    metrics.register(Gauge(
+        "user_data_bytes", "Approximate size of the in-memory user_data as JSON",
+        lambda: sum(len(json.dumps(data, default=str)) for data in application.user_data.values())
+    ))
+    port = METRICS_PORT + (_current_shard or 0) # Shards on one host need their own port
+    _metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, port)
+    logger.info(f"Serving metrics on http://{METRICS_LISTEN}:{port}/metrics")
+
 # --- Telegram Bot Handlers ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -164,6 +2362,25 @@ async def receive_feedback_text(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Please send valid text feedback.")
     return ConversationHandler.END # End the feedback conversation
 
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command: profiles the bot for a number of seconds and replies with the report."""
+    if not update.message or update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    try:
+        duration = float(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [seconds]")
+        return
+    duration = min(max(duration, 1), PROFILE_MAX_SECONDS)
+
+    async def send_report(report, path):
+        await update.message.reply_text(f"Profiling report ({path}):\n{report}"[:4096])
+
+    if start_profile(duration, send_report):
+        await update.message.reply_text(f"Profiling the bot for {duration:g} seconds...")
+    else:
+        await update.message.reply_text("A profiling run is already in progress.")
+
 async def describe_image_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Placeholder for image description feature."""
     if update.message:
@@ -192,7 +2409,11 @@ async def receive_initial_prompt(update: Update, context: ContextTypes.DEFAULT_T
         return ConversationHandler.END
     
     user_prompt = update.message.text.strip()
+    if cancel_generation_jobs(update.effective_chat.id):
+        logger.info(f"Stopped running generation for {update.effective_user.id} because a new prompt arrived")
+    speculative_prefetcher.abandon(update.effective_chat.id)
     context.user_data['prompt'] = user_prompt
+    context.user_data.pop('seed', None) # Fresh prompt, allow cached results again
     logger.info(f"User {update.effective_user.id} initiated image generation with prompt: '{user_prompt}'")
 
     # Add current prompt to recent prompts history
@@ -213,6 +2434,14 @@ async def receive_initial_prompt(update: Update, context: ContextTypes.DEFAULT_T
     # Add "Use Saved Settings" button if settings exist
     if 'saved_settings' in context.user_data and context.user_data['saved_settings']:
         keyboard.append([InlineKeyboardButton("Use Saved Settings", callback_data="use_saved_settings")])
+        saved_settings = context.user_data['saved_settings']
+        if SPECULATIVE_PREFETCH and saved_settings.get('output_type', "images") == "images":
+            # Saved settings fix every parameter, so their images can be fetched right away
+            full_prompt, width, height = resolve_generation_parameters(saved_settings)
+            await speculative_prefetcher.start(
+                update.effective_chat.id, full_prompt, saved_settings.get('num_images'),
+                width, height, None, saved_settings.get('generation_timeout', DEFAULT_IMAGE_TIMEOUT)
+            )
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -227,6 +2456,9 @@ async def handle_negative_prompt_choice(update: Update, context: ContextTypes.DE
     query = update.callback_query
     await query.answer()
 
+    if query.data != "use_saved_settings":
+        speculative_prefetcher.abandon(query.message.chat_id) # Not using the saved settings after all
+
     if query.data == "add_negative_prompt":
         await query.edit_message_text("Please send me the negative prompt (e.g., 'ugly, blurry, deformed').")
         context.user_data['awaiting_negative_prompt'] = True
@@ -382,7 +2614,6 @@ async def choose_ratio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
     chosen_ratio_name = query.data.replace("ratio_", "")
     if chosen_ratio_name == "random":
-        import random
         chosen_ratio_name = random.choice(list(RATIOS.keys()))
         await query.edit_message_text(f"Random ratio selected: '{chosen_ratio_name}'.")
         await asyncio.sleep(0.5) # Small delay for user to see the random choice
@@ -416,7 +2647,6 @@ async def choose_style_and_generate(update: Update, context: ContextTypes.DEFAUL
 
     chosen_style = query.data.replace("style_", "")
     if chosen_style == "random":
-        import random
         chosen_style = random.choice(STYLES)
         await query.edit_message_text(f"Random style selected: '{chosen_style}'.")
         await asyncio.sleep(0.5) # Small delay for user to see the random choice
@@ -425,26 +2655,18 @@ async def choose_style_and_generate(update: Update, context: ContextTypes.DEFAUL
     logger.info(f"User {update.effective_user.id} selected style: {chosen_style}")
 
     # Retrieve all necessary data from context.user_data
-    prompt = context.user_data.get('prompt')
-    negative_prompt = context.user_data.get('negative_prompt', "")
-    ratio_name = context.user_data.get('ratio')
-    quality_name = context.user_data.get('quality')
-    num_images = context.user_data.get('num_images')
     generation_timeout = context.user_data.get('generation_timeout', DEFAULT_IMAGE_TIMEOUT) # Use default if not set
-
-    base_width, base_height = QUALITIES.get(quality_name, (1024, 1024))
-    ratio_w, ratio_h = RATIOS.get(ratio_name, (1, 1))
-
-    # Calculate actual width and height based on quality and aspect ratio
-    if ratio_w >= ratio_h:
-        width = base_width
-        height = int(base_width * (ratio_h / ratio_w))
-    else:
-        height = base_height
-        width = int(base_height * (ratio_w / ratio_h))
+    full_prompt, width, height = resolve_generation_parameters(context.user_data)
 
     logger.info(f"Generating with dimensions: {width}x{height}, timeout: {generation_timeout}s")
 
+    if SPECULATIVE_PREFETCH:
+        # Everything but the output type is known; most users pick images, so start on them now
+        await speculative_prefetcher.start(
+            query.message.chat_id, full_prompt, context.user_data.get('num_images'),
+            width, height, context.user_data.get('seed'), generation_timeout
+        )
+
     # Ask user for output type (images or URLs)
     keyboard = [
         [
@@ -459,147 +2681,410 @@ async def choose_style_and_generate(update: Update, context: ContextTypes.DEFAUL
     )
     return ASK_OUTPUT_TYPE
 
+async def send_post_generation_buttons(context: ContextTypes.DEFAULT_TYPE, chat_id, sent_images=None, num_images=None) -> None:
+    """
+    Sends the closing message with the 'Regenerate', 'Start New', 'Save Settings' and 'Upscale' buttons,
+    summarizing how many images were sent if the counts are given.
+    """
+    final_keyboard = [
+        [
+            InlineKeyboardButton("Regenerate (Same Settings)", callback_data="regenerate"),
+            InlineKeyboardButton("Start New Generation", callback_data="start_new")
+        ],
+        [
+            InlineKeyboardButton("Save Current Settings", callback_data="save_current_settings"),
+            InlineKeyboardButton("Upscale/Enhance (Experimental)", callback_data="upscale_image")
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(final_keyboard)
+
+    summary = "All done!"
+    if sent_images is not None and sent_images < num_images:
+        summary = f"All done! Sent {sent_images} of {num_images} images."
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"{summary} Please note that images generated by Pollinations AI may include a watermark that cannot be removed by the bot.",
+        reply_markup=reply_markup
+    )
+
 async def handle_output_type_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the user's choice for output type (images or URLs) and starts generation."""
     query = update.callback_query
     await query.answer()
 
     output_type = query.data.replace("output_", "")
-    context.user_data['output_type'] = output_type
     logger.info(f"User {update.effective_user.id} chose output type: {output_type}")
+    return await start_generation(update, context, output_type)
+
+async def start_generation(update: Update, context: ContextTypes.DEFAULT_TYPE, output_type) -> int:
+    """
+    Generates images (or URLs) from the settings in user_data, answering the
+    update's callback query. Shared by the output type choice, Regenerate and
+    saved settings.
+    """
+    query = update.callback_query
+    context.user_data['output_type'] = output_type
 
     # Retrieve all necessary data from context.user_data for generation
-    prompt = context.user_data.get('prompt')
-    negative_prompt = context.user_data.get('negative_prompt', "")
-    ratio_name = context.user_data.get('ratio')
-    quality_name = context.user_data.get('quality')
     num_images = context.user_data.get('num_images')
     generation_timeout = context.user_data.get('generation_timeout', DEFAULT_IMAGE_TIMEOUT)
+    seed = context.user_data.get('seed') # Set by Regenerate to get fresh images instead of cached ones
+    full_prompt, width, height = resolve_generation_parameters(context.user_data)
+
+    if output_type == "urls":
+        speculative_prefetcher.abandon(query.message.chat_id) # The URLs are warmed up below instead
+        # URLs don't need the image bytes, so hand them out right away
+        image_urls_list = [
+            build_image_generation_url(f"{full_prompt} (variation {i + 1})", width, height, seed)
+            for i in range(num_images)
+        ]
+        urls_text = "\n".join(image_urls_list)
+        await query.edit_message_text(
+            f"Here are the image URLs:\n{urls_text}",
+            disable_web_page_preview=False # Allow preview for URLs
+        )
+        logger.info(f"Successfully sent {len(image_urls_list)} image URLs to {update.effective_user.id}")
+        if URL_MODE_WARMUP:
+            for image_generation_url in image_urls_list:
+                start_url_warmup(image_generation_url, generation_timeout)
+        await send_post_generation_buttons(context, query.message.chat_id)
+        return ConversationHandler.END
 
-    base_width, base_height = QUALITIES.get(quality_name, (1024, 1024))
-    ratio_w, ratio_h = RATIOS.get(ratio_name, (1, 1))
+    # Record the job durably before starting it, so it can be resumed after a restart
+    job = {
+        'chat_id': query.message.chat_id,
+        'user_id': update.effective_user.id,
+        'full_prompt': full_prompt,
+        'num_images': num_images,
+        'width': width,
+        'height': height,
+        'seed': seed,
+        'generation_timeout': generation_timeout,
+    }
+    job['job_id'] = await generation_job_store.create(job)
+
+    # Generate in the background so the bot keeps serving other updates meanwhile,
+    # and so the job can be stopped by /cancel, a new prompt or the Stop button
+    start_generation_job(context.application, job['chat_id'], generate_images(context, job, query), update=update)
+    return ConversationHandler.END
 
-    if ratio_w >= ratio_h:
-        width = base_width
-        height = int(base_width * (ratio_h / ratio_w))
-    else:
-        height = base_height
-        width = int(base_height * (ratio_w / ratio_h))
+
+async def generate_images(context: ContextTypes.DEFAULT_TYPE, job, query=None) -> None:
+    """
+    Fetches the image variants of a generation job, provides progress updates,
+    sends each image as soon as it is ready (or all at the end) and offers "Regenerate" or "Start New" options.
+    Runs as a cancellable background job, either started by start_generation
+    (with the user's callback query) or resumed after a restart (without one).
+    """
+    user_id = job['user_id']
+    if not generation_scheduler.try_start_job(user_id):
+        text = f"You already have {MAX_ACTIVE_JOBS_PER_USER} generations running. Please wait for them to finish and try again."
+        if query is not None:
+            await query.edit_message_text(text)
+        else:
+            await context.bot.send_message(chat_id=job['chat_id'], text=text)
+        await generation_job_store.finish(job['job_id'])
+        GENERATION_JOBS.inc("rejected")
+        return
+    trace = JobTrace(job)
+    _current_trace.set(trace) # This task's context; the fetch and progress tasks inherit it
+    logger.info(f"Generation job {job['job_id']} for {user_id} has trace ID {trace.trace_id}")
+    outcome = "crashed"
+    try:
+        outcome = await _generate_images(context, job, query)
+        await generation_job_store.finish(job['job_id'])
+    except asyncio.CancelledError:
+        outcome = "interrupted"
+        if asyncio.current_task() in _user_stopped_jobs:
+            outcome = "stopped"
+            await generation_job_store.finish(job['job_id'])
+        raise # Otherwise the bot is shutting down; keep the job so it resumes on the next start
+    except Exception:
+        await generation_job_store.finish(job['job_id']) # Don't resume a job that crashes every time
+        raise
+    finally:
+        generation_scheduler.finish_job(user_id)
+        GENERATION_JOBS.inc(outcome)
+        trace.finish(outcome)
+
+async def _generate_images(context, job, query):
+    """Runs a generation job and returns its outcome for the metrics."""
+    job_id = job['job_id']
+    chat_id = job['chat_id']
+    user_id = job['user_id']
+    full_prompt = job['full_prompt']
+    num_images = job['num_images']
+    width, height, seed = job['width'], job['height'], job['seed']
+    generation_timeout = job['generation_timeout']
+    delivered_images = job.get('delivered_images', set()) # Already sent before a restart
+    image_nums = [num for num in range(1, num_images + 1) if num not in delivered_images]
 
     # Inform the user that generation is starting and provide initial progress
+    stop_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Stop", callback_data="stop_generation")]])
     generation_message_text = f"Starting image generation. Generating 0 of {num_images} images... {get_progress_bar(0, num_images)}"
-    generation_message = await query.edit_message_text(generation_message_text)
-    await context.bot.send_chat_action(chat_id=query.message.chat_id, action='upload_photo')
+    if query is not None:
+        generation_message = await query.edit_message_text(generation_message_text, reply_markup=stop_markup)
+    else:
+        generation_message = await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"The bot was restarted while generating your images, resuming now...\n{generation_message_text}",
+            reply_markup=stop_markup
+        )
+    await context.bot.send_chat_action(chat_id=chat_id, action='upload_photo')
 
-    media_group = [] # For InputMediaPhoto objects
-    image_urls_list = [] # For direct URLs
+    sent_images = len(delivered_images)
+    original_documents = [] # InputMediaDocument objects with the unmodified files
 
-    for i in range(num_images):
-        current_image_num = i + 1
-        
-        # Update the progress message in the chat with animation and progress bar
-        try:
-            current_frame_index = i % 3 # For . .. ... animation
-            animated_text = f"Generating image {current_image_num} of {num_images}{'. ' * current_frame_index} {get_progress_bar(current_image_num, num_images)}"
-            await context.bot.edit_message_text(
-                chat_id=generation_message.chat_id,
-                message_id=generation_message.message_id,
-                text=animated_text
-            )
-            await asyncio.sleep(0.5)
-        except Exception as edit_error:
-            logger.warning(f"Could not edit message for progress update: {edit_error}")
+    # Fetch all variants concurrently, capped per request so one job can't hog the pool
+    fetch_semaphore = asyncio.Semaphore(MAX_PARALLEL_FETCHES_PER_REQUEST)
+    completed_images = len(delivered_images)
 
-        full_prompt = f"{prompt}, {context.user_data['style']} style"
-        if negative_prompt:
-            full_prompt += f", no {negative_prompt}"
-        
+    async def fetch_variant(current_image_num):
+        nonlocal completed_images
         variant_prompt = f"{full_prompt} (variation {current_image_num})"
-        
-        try:
-            encoded_prompt = urllib.parse.quote(variant_prompt)
-            image_generation_url = f"{POLLINATIONS_IMAGE_API}{encoded_prompt}?width={width}&height={height}"
-            logger.info(f"Attempting to fetch image {current_image_num}/{num_images} from URL: {image_generation_url}")
-
-            response = requests.get(image_generation_url, stream=True, timeout=generation_timeout)
-            response.raise_for_status()
+        image_generation_url = build_image_generation_url(variant_prompt, width, height, seed)
+        cache_key = generation_cache_key(variant_prompt, width, height, seed)
+        image_file = None
+        # An image Telegram already has can be sent by file_id, no bytes needed
+        file_id = telegram_file_ids.get(cache_key)
+        if file_id is not None:
+            logger.info(f"Reusing Telegram file_id for image {current_image_num}/{num_images}")
+            IMAGE_SOURCES.inc("file_id")
+            if SEND_ORIGINALS_AS_DOCUMENTS:
+                image_file = await image_cache.get(cache_key) # Only needed for the document
+        else:
+            image_file = await image_cache.get(cache_key)
+            if image_file is None:
+                prefetch = speculative_prefetcher.claim(cache_key)
+                if prefetch is not None:
+                    logger.info(f"Waiting for speculative fetch of image {current_image_num}/{num_images}")
+                    try:
+                        await asyncio.shield(prefetch) # Stopping this job shouldn't waste the fetch
+                    except Exception:
+                        pass # Fetch it again below
+                    image_file = await image_cache.get(cache_key)
+                    if image_file is not None:
+                        IMAGE_SOURCES.inc("speculative")
+            if image_file is None:
+                if not pollinations_health.is_available():
+                    raise BackendUnavailableError("Pollinations circuit breaker is open") # Don't queue for a dead backend
+
+                async def fetch_into_cache():
+                    # Only runs for the first job asking for the image; later ones join its call
+                    IMAGE_SOURCES.inc("pollinations")
+                    queued_at = time.monotonic()
+                    async with fetch_semaphore, generation_scheduler.slot(user_id):
+                        record_stage("queue", queued_at, image=current_image_num)
+                        logger.debug(f"Attempting to fetch image {current_image_num}/{num_images} from URL: {image_generation_url}")
+                        with stage("fetch", image=current_image_num):
+                            fetched_file = await fetch_generation_image(image_generation_url, generation_timeout)
+                    with fetched_file:
+                        with stage("cache_put", image=current_image_num):
+                            await image_cache.put(cache_key, fetched_file)
+                        return fetched_file.read()
+
+                # Jobs asking for the same image at the same time share one upstream request
+                if coalesced_fetches.in_flight(cache_key):
+                    IMAGE_SOURCES.inc("coalesced")
+                # The bytes end up in the disk cache, so a resumed job won't fetch them again
+                image_file = BytesIO(await coalesced_fetches.run(cache_key, fetch_into_cache))
+            else:
+                logger.info(f"Serving image {current_image_num}/{num_images} from cache")
+                IMAGE_SOURCES.inc("cache")
+
+        photo_bytes = original_bytes = thumbnail_bytes = None
+        if image_file is not None:
+            # The upload needs the bytes in memory anyway; read them once and release the file
+            with image_file:
+                original_bytes = image_file.read()
+            with stage("postprocess", image=current_image_num):
+                # The thumbnail is only shown on the original's document
+                photo_bytes, thumbnail_bytes = await postprocess_image(original_bytes, SEND_ORIGINALS_AS_DOCUMENTS)
+            if not SEND_ORIGINALS_AS_DOCUMENTS:
+                original_bytes = None
+        logger.debug(f"Successfully prepared image {current_image_num} for prompt: '{variant_prompt}'")
 
-            if output_type == "images":
-                image_bytes = BytesIO(response.content)
-                media_group.append(InputMediaPhoto(media=image_bytes))
-            else: # output_type == "urls"
-                image_urls_list.append(image_generation_url)
-            
-            logger.info(f"Successfully prepared image {current_image_num} for prompt: '{variant_prompt}'")
+        # Update the progress message in the chat with animation and progress bar
+        completed_images += 1
+        current_frame_index = completed_images % 3 # For . .. ... animation
+        progress.update(
+            f"Generated {completed_images} of {num_images} images{'. ' * current_frame_index} {get_progress_bar(completed_images, num_images)}"
+        )
 
-        except requests.exceptions.Timeout:
-            logger.error(f"Timeout fetching image {current_image_num} for {update.effective_user.id}")
+        return image_generation_url, cache_key, file_id, photo_bytes, original_bytes, thumbnail_bytes
+
+    async def report_queue_position():
+        # Tell the user where they are in line while none of their fetches has started yet
+        while completed_images == len(delivered_images):
+            position = generation_scheduler.queue_position(user_id)
+            if position and generation_scheduler.in_flight(user_id) == 0:
+                progress.update(
+                    f"The bot is busy. You are number {position} in the queue for {num_images} images... {get_progress_bar(0, num_images)}"
+                )
+            await asyncio.sleep(QUEUE_POSITION_UPDATE_INTERVAL)
+
+    async def report_failed_image(current_image_num, error):
+        if isinstance(error, BackendUnavailableError):
+            nonlocal backend_down_reported
+            GENERATION_ERRORS.inc("backend_unavailable")
+            logger.error(f"Skipped image {current_image_num} for {user_id}: {error}")
+            if not backend_down_reported: # One notice is enough when the whole backend is down
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text="Pollinations AI is currently not responding, so some images were skipped. Please try again in a minute."
+                )
+                backend_down_reported = True
+        elif isinstance(error, httpx.TimeoutException):
+            GENERATION_ERRORS.inc("timeout")
+            logger.error(f"Timeout fetching image {current_image_num} for {user_id}")
             await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"Image {current_image_num} generation timed out. Pollinations AI might be experiencing high load. Trying next image..."
+                chat_id=chat_id,
+                text=f"Image {current_image_num} generation timed out. Pollinations AI might be experiencing high load."
             )
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching image {current_image_num} from Pollinations AI for {update.effective_user.id}: {e}")
+        elif isinstance(error, InvalidImageError):
+            GENERATION_ERRORS.inc("invalid_image")
+            logger.error(f"Invalid image {current_image_num} from Pollinations AI for {user_id}: {error}")
             await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"Sorry, I couldn't generate image {current_image_num} for you due to a network or API issue. Trying next image..."
+                chat_id=chat_id,
+                text=f"Sorry, Pollinations AI didn't return a usable image for image {current_image_num}."
             )
-        except Exception as e:
-            logger.error(f"An unexpected error occurred for image {current_image_num} for {update.effective_user.id}: {e}")
+        elif isinstance(error, httpx.HTTPError):
+            GENERATION_ERRORS.inc("http")
+            logger.error(f"Error fetching image {current_image_num} from Pollinations AI for {user_id}: {error}")
             await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"An unexpected error occurred while trying to generate image {current_image_num}. Trying next image..."
+                chat_id=chat_id,
+                text=f"Sorry, I couldn't generate image {current_image_num} for you due to a network or API issue."
             )
-    
+        else:
+            GENERATION_ERRORS.inc("unexpected")
+            logger.error(f"An unexpected error occurred for image {current_image_num} for {user_id}: {error}")
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"An unexpected error occurred while trying to generate image {current_image_num}."
+            )
+
+    async def send_images(ready):
+        # Sends finished images, as single photos or media groups of up to TELEGRAM_MEDIA_GROUP_LIMIT
+        nonlocal sent_images
+        for start in range(0, len(ready), TELEGRAM_MEDIA_GROUP_LIMIT):
+            batch = ready[start:start + TELEGRAM_MEDIA_GROUP_LIMIT]
+            photos = [] # (file_id or bytes, filename)
+            for current_image_num, (image_generation_url, cache_key, file_id, photo_bytes, original_bytes, thumbnail_bytes) in batch:
+                if file_id is not None:
+                    photos.append((file_id, None))
+                else:
+                    photos.append((photo_bytes, f"image_{current_image_num}.jpg"))
+                if original_bytes is not None:
+                    original_documents.append(InputMediaDocument(
+                        media=original_bytes,
+                        filename=f"image_{current_image_num}_original.{image_file_extension(original_bytes)}",
+                        thumbnail=thumbnail_bytes
+                    ))
+            media_keys = [result[1] for _, result in batch]
+            try:
+                with stage("upload", images=[num for num, _ in batch], method="sendPhoto" if len(photos) == 1 else "sendMediaGroup"):
+                    if len(photos) == 1:
+                        photo, filename = photos[0]
+                        sent_messages = [await context.bot.send_photo(chat_id=chat_id, photo=photo, filename=filename)]
+                    else:
+                        media_group = [InputMediaPhoto(media=photo, filename=filename) for photo, filename in photos]
+                        sent_messages = await context.bot.send_media_group(chat_id=chat_id, media=media_group)
+                telegram_file_ids.remember_sent_photos(media_keys, sent_messages)
+                await generation_job_store.checkpoint(job_id, [num for num, _ in batch], JOB_IMAGE_UPLOADED)
+                sent_images += len(batch)
+                logger.info(f"Successfully sent {len(batch)} images to {user_id}")
+            except Exception as e:
+                GENERATION_ERRORS.inc("upload")
+                logger.error(f"Error sending media group to {user_id}: {e}")
+                # A stale file_id can break the whole group; forget them so the next attempt uploads bytes
+                for key in media_keys:
+                    telegram_file_ids.discard(key)
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text="Finished generating images, but had trouble sending some of them. Please try again."
+                )
+
+    progress = ProgressReporter(context.bot, generation_message, reply_markup=stop_markup)
+    queue_reporter = asyncio.create_task(report_queue_position())
+    backend_down_reported = False
+    fetches = {asyncio.create_task(fetch_variant(num)): num for num in image_nums}
+    try:
+        # With progressive delivery every image goes out as soon as it is ready; images that
+        # finish while an upload is running are sent together with the next one
+        return_when = asyncio.FIRST_COMPLETED if PROGRESSIVE_DELIVERY else asyncio.ALL_COMPLETED
+        pending = set(fetches)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=return_when)
+            ready = []
+            for fetch in sorted(done, key=fetches.get):
+                if fetch.exception() is not None:
+                    await report_failed_image(fetches[fetch], fetch.exception())
+                else:
+                    ready.append((fetches[fetch], fetch.result()))
+            await send_images(ready)
+    except asyncio.CancelledError:
+        # Cancelling the fetches aborts queued and in-flight requests and frees their connections
+        logger.info(f"Image generation for {user_id} was stopped")
+        await progress.close()
+        if asyncio.current_task() in _user_stopped_jobs:
+            text = "Image generation stopped. Send me a prompt to start again."
+        else:
+            text = "The bot is restarting. Your images will continue after the restart."
+        try:
+            await context.bot.edit_message_text(
+                chat_id=generation_message.chat_id,
+                message_id=generation_message.message_id,
+                text=text
+            )
+        except Exception as edit_error:
+            logger.warning(f"Could not edit message after stopping generation: {edit_error}")
+        raise
+    finally:
+        queue_reporter.cancel()
+        for fetch in fetches:
+            fetch.cancel()
+
     # Attempt to delete the final progress message
+    await progress.close()
     try:
         await context.bot.delete_message(chat_id=generation_message.chat_id, message_id=generation_message.message_id)
     except Exception as delete_error:
         logger.warning(f"Could not delete generation message: {delete_error}")
 
-    if output_type == "images" and media_group:
-        try:
-            await context.bot.send_media_group(chat_id=query.message.chat_id, media=media_group)
-            logger.info(f"Successfully sent all {len(media_group)} images to {update.effective_user.id}")
-        except Exception as e:
-            logger.error(f"Error sending media group to {update.effective_user.id}: {e}")
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text="Finished generating images, but had trouble sending them as a group. You might see some individually."
-            )
-    elif output_type == "urls" and image_urls_list:
-        urls_text = "\n".join(image_urls_list)
+    if sent_images == 0:
         await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=f"Here are the image URLs:\n{urls_text}",
-            disable_web_page_preview=False # Allow preview for URLs
-        )
-        logger.info(f"Successfully sent {len(image_urls_list)} image URLs to {update.effective_user.id}")
-    else:
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
+            chat_id=chat_id,
             text="No images could be generated successfully with your request. Please try again."
         )
 
-    # Add post-generation buttons
-    final_keyboard = [
-        [
-            InlineKeyboardButton("Regenerate (Same Settings)", callback_data="regenerate"),
-            InlineKeyboardButton("Start New Generation", callback_data="start_new")
-        ],
-        [
-            InlineKeyboardButton("Save Current Settings", callback_data="save_current_settings"),
-            InlineKeyboardButton("Upscale/Enhance (Experimental)", callback_data="upscale_image")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(final_keyboard)
+    for start in range(0, len(original_documents), TELEGRAM_MEDIA_GROUP_LIMIT):
+        try:
+            with stage("upload_originals", documents=len(original_documents[start:start + TELEGRAM_MEDIA_GROUP_LIMIT])):
+                await context.bot.send_media_group(chat_id=chat_id, media=original_documents[start:start + TELEGRAM_MEDIA_GROUP_LIMIT])
+        except Exception as e:
+            GENERATION_ERRORS.inc("upload_original")
+            logger.error(f"Error sending original files to {user_id}: {e}")
 
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="All done! Please note that images generated by Pollinations AI may include a watermark that cannot be removed by the bot.",
-        reply_markup=reply_markup
-    )
-    return ConversationHandler.END
+    await send_post_generation_buttons(context, chat_id, sent_images, num_images)
+    if sent_images == num_images:
+        return "completed"
+    return "partial" if sent_images else "failed"
+
+
+async def resume_generation_jobs(application: Application, jobs) -> None:
+    """
+    Restarts the generation jobs that were still running when the bot stopped.
+    jobs is read before start(), so jobs created by updates queued during the
+    downtime are not mistaken for unfinished ones and run twice.
+    """
+    while not application.running: # post_init runs before start(); jobs must be tracked by the running app
+        await asyncio.sleep(0.1)
+    for job in jobs:
+        if not owns_user(job['user_id']):
+            continue # Resumed by the shard that owns the user
+        logger.info(f"Resuming generation job {job['job_id']} for {job['user_id']} ({len(job['delivered_images'])} of {job['num_images']} images already sent)")
+        context = CallbackContext(application, chat_id=job['chat_id'], user_id=job['user_id'])
+        start_generation_job(application, job['chat_id'], generate_images(context, job))
 
 
 async def handle_post_generation_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -617,12 +3102,8 @@ async def handle_post_generation_buttons(update: Update, context: ContextTypes.D
             await context.bot.send_message(query.message.chat_id, "Regenerating images with the same settings...")
 
         # Re-trigger the generation process using the stored user_data
-        # We simulate the last step of the conversation to re-enter the generation function
-        dummy_query = Update(update_id=update.update_id)
-        dummy_query.callback_query = query
-        dummy_query.callback_query.data = f"output_{context.user_data['output_type']}" # Simulate choosing output type again
-
-        return await handle_output_type_choice(dummy_query, context)
+        context.user_data['seed'] = random.randint(0, 2**31 - 1) # New seed so cached results are bypassed
+        return await start_generation(update, context, context.user_data.get('output_type', "images"))
 
     elif query.data == "start_new":
         # Clear user data (except recent prompts) to reset the conversation state
@@ -689,22 +3170,12 @@ async def load_saved_settings(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Apply saved settings to current user_data for generation
     context.user_data.update(saved_settings)
+    context.user_data.pop('seed', None) # Saved settings replay the same images, so they can come from cache
     logger.info(f"User {update.effective_user.id} loaded saved settings: {saved_settings}")
     
     await query.edit_message_text("Using your saved settings for generation. Proceeding to image creation!")
-    # Directly jump to the generation phase. We need to simulate the last callback needed.
-    dummy_query = Update(update_id=update.update_id)
-    dummy_query.callback_query = query
-    # This ensures choose_style_and_generate receives the correct 'style' callback data
-    dummy_query.callback_query.data = f"style_{saved_settings['style']}"
-    
-    # We now call handle_output_type_choice because that's the point before generation starts.
-    # We need to simulate the output type being chosen from saved settings.
-    dummy_query_for_output_type = Update(update_id=update.update_id)
-    dummy_query_for_output_type.callback_query = query
-    dummy_query_for_output_type.callback_query.data = f"output_{saved_settings.get('output_type', 'images')}"
-
-    return await handle_output_type_choice(dummy_query_for_output_type, context)
+    # Directly jump to the generation phase with the saved output type
+    return await start_generation(update, context, saved_settings.get('output_type', "images"))
 
 
 async def handle_start_new_prompt_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -758,8 +3229,21 @@ async def ask_negative_prompt_for_recent(update: Update, context: ContextTypes.D
     return ASK_NEGATIVE_PROMPT
 
 
+async def stop_generation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles the 'Stop' button on the progress message."""
+    query = update.callback_query
+    if cancel_generation_jobs(query.message.chat_id):
+        logger.info(f"User {update.effective_user.id} stopped their image generation.")
+        await query.answer("Stopping image generation...")
+    else:
+        await query.answer("There is no image generation running.")
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
+    if update.effective_chat:
+        cancel_generation_jobs(update.effective_chat.id) # Abort any images still being generated
+        speculative_prefetcher.abandon(update.effective_chat.id)
     if update.message:
         user_id = update.effective_user.id
         logger.info(f"User {user_id} cancelled the conversation.")
@@ -775,11 +3259,219 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+# --- Sharding ---
+
+class ConsistentHashRing:
+    """
+    Maps user IDs to shards. Every shard owns many points on a hash ring, so
+    changing the number of shards only moves the users next to the added or
+    removed points.
+    """
+
+    def __init__(self, shard_count, virtual_nodes=SHARD_VIRTUAL_NODES):
+        points = sorted(
+            (self._hash(f"shard-{shard}-{node}"), shard)
+            for shard in range(shard_count)
+            for node in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(value) -> int:
+        return int.from_bytes(hashlib.sha256(str(value).encode()).digest()[:8], "big")
+
+    def owner(self, key) -> int:
+        """Returns the index of the shard that owns the key."""
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+shard_ring = ConsistentHashRing(SHARD_COUNT)
+_current_shard = None # Index of the shard this process runs, None without sharding
+
+def owns_user(user_id) -> bool:
+    """True if this process is responsible for the user."""
+    return _current_shard is None or shard_ring.owner(user_id) == _current_shard
+
+def shard_socket_path(shard_index) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f"shard-{shard_index}.sock")
+
+class ShardRouter:
+    """
+    Runs in the ingress process and forwards every update to the shard that
+    owns its user, as one JSON line per update over the shard's Unix socket.
+    Routing by user rather than chat keeps a user's user_data and all their
+    conversations in one process, even when they use the bot in several chats.
+
+    forward() only puts the update into its shard's queue, and a writer task
+    per shard sends the queue in order, so a slow or restarting shard never
+    holds up updates for the others. The router also starts the shard
+    processes and restarts any that exit.
+    """
+
+    def __init__(self, shard_count):
+        self._process_context = multiprocessing.get_context("spawn")
+        self._processes = [None] * shard_count
+        self._queues = [asyncio.Queue(SHARD_QUEUE_MAX_UPDATES) for _ in range(shard_count)]
+        self._tasks = []
+
+    def _start_shard(self, shard_index) -> None:
+        process = self._process_context.Process(target=run_shard, args=(shard_index,), name=f"shard-{shard_index}")
+        process.start()
+        self._processes[shard_index] = process
+
+    def start_shards(self) -> None:
+        for shard_index in range(len(self._processes)):
+            self._start_shard(shard_index)
+
+    def stop_shards(self) -> None:
+        for process in self._processes:
+            process.terminate() # SIGTERM lets the shard stop gracefully
+        for process in self._processes:
+            process.join()
+
+    async def start(self, application: Application) -> None:
+        """Starts the writer tasks and the shard monitor; used as post_init of the ingress."""
+        self._tasks = [asyncio.create_task(self._write_updates(shard_index)) for shard_index in range(len(self._queues))]
+        self._tasks.append(asyncio.create_task(self._monitor_shards()))
+
+    async def close(self, application: Application) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _monitor_shards(self) -> None:
+        while True:
+            await asyncio.sleep(SHARD_MONITOR_INTERVAL)
+            for shard_index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.error(f"Shard {shard_index} exited with code {process.exitcode}, restarting it")
+                    self._start_shard(shard_index)
+
+    async def _connect(self, shard_index):
+        """Opens a connection to a shard, waiting while it starts up but failing at once if its process is gone."""
+        deadline = time.monotonic() + SHARD_CONNECT_TIMEOUT
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(shard_socket_path(shard_index))
+                return writer
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not self._processes[shard_index].is_alive() or time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2) # The shard is still starting up
+
+    async def _write_updates(self, shard_index) -> None:
+        """Sends a shard's queued updates in order, reconnecting until the shard is reachable again."""
+        queue = self._queues[shard_index]
+        writer = None
+        try:
+            while True:
+                line = await queue.get()
+                while True:
+                    try:
+                        if writer is None or writer.is_closing():
+                            writer = await self._connect(shard_index)
+                        writer.write(line)
+                        await writer.drain()
+                        break
+                    except OSError as e:
+                        writer = None
+                        logger.warning(
+                            f"Shard {shard_index} is unreachable ({e}), {queue.qsize() + 1} updates waiting for it"
+                        )
+                        await asyncio.sleep(SHARD_MONITOR_INTERVAL) # Gives the monitor time to restart it
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        owner = update.effective_user or update.effective_chat
+        shard_index = shard_ring.owner(owner.id if owner else 0)
+        try:
+            self._queues[shard_index].put_nowait(update.to_json().encode() + b"\n")
+        except asyncio.QueueFull:
+            logger.error(f"Dropped update {update.update_id}: shard {shard_index} has been unreachable for too long")
+
+async def serve_shard(shard_index) -> None:
+    """Runs the bot for the users of one shard, with updates coming from the ingress."""
+    global _current_shard
+    _current_shard = shard_index
+    # The disk cache index lives in memory, so every shard gets its own directory and share of the size cap
+    image_cache.directory = os.path.join(CACHE_DIR, f"shard-{shard_index}")
+    image_cache.disk_max_bytes = CACHE_DISK_MAX_BYTES // SHARD_COUNT
+    application = build_application(receive_updates=False)
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_requested.set)
+
+    connections = set()
+
+    async def receive_updates(reader, writer):
+        connections.add(writer)
+        try:
+            while line := await reader.readline():
+                await application.update_queue.put(Update.de_json(json.loads(line), application.bot))
+        finally:
+            connections.discard(writer)
+            writer.close()
+
+    socket_path = shard_socket_path(shard_index)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path) # Left over from a previous run
+    async with application: # initialize() and shutdown()
+        await application.post_init(application)
+        await application.start()
+        server = await asyncio.start_unix_server(receive_updates, path=socket_path)
+        logger.info(f"Shard {shard_index} of {SHARD_COUNT} is accepting updates on {socket_path}")
+        await stop_requested.wait()
+        server.close()
+        for writer in list(connections):
+            writer.close() # Ends the reading loops
+        await application.stop()
+    await application.post_shutdown(application)
+
+def run_shard(shard_index) -> None:
+    """Entry point of a shard process."""
+    asyncio.run(serve_shard(shard_index))
+
+def run_sharded() -> None:
+    """Starts one process per shard and receives updates for all of them in this process."""
+    os.makedirs(SHARD_SOCKET_DIR, exist_ok=True)
+    router = ShardRouter(SHARD_COUNT)
+    router.start_shards()
+    ingress = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN).base_url(TELEGRAM_API_BASE_URL)
+        .post_init(router.start).post_shutdown(router.close).build()
+    )
+    ingress.add_handler(TypeHandler(Update, router.forward))
+    logger.info(f"Ingress started for {SHARD_COUNT} shards. Press Ctrl-C to stop.")
+    try:
+        run_application(ingress)
+    finally:
+        router.stop_shards()
+
+
 # --- Main Bot Function ---
 
-def main() -> None:
-    """Starts the bot."""
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(receive_updates=True) -> Application:
+    """Creates the bot application with all its handlers."""
+    builder = (
+        Application.builder()
+        .application_class(GenerationApplication)
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        # Telegram's global limit is per bot, so shards split it between them
+        .rate_limiter(PriorityRateLimiter(global_rate=TELEGRAM_GLOBAL_REQUESTS_PER_SECOND / SHARD_COUNT))
+        .persistence(SQLitePersistence(PERSISTENCE_DB_PATH))
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+    )
+    if WEBHOOK_URL:
+        builder.concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+    if not receive_updates:
+        builder.updater(None) # Updates are put into the update queue by serve_shard
+    application = builder.build()
 
     # Conversation Handler defines the multi-step flow for image generation
     conv_handler = ConversationHandler(
@@ -806,8 +3498,11 @@ def main() -> None:
             GET_FEEDBACK_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_feedback_text)]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="image_generation",
+        persistent=True
     )
+    count_state_entries(conv_handler) # Per-step drop-off for the metrics
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -815,12 +3510,39 @@ def main() -> None:
     application.add_handler(CommandHandler("clear_data", clear_data_command))
     application.add_handler(CommandHandler("feedback", feedback_command)) # Entry point for feedback
     application.add_handler(CommandHandler("describe_image", describe_image_command)) # Placeholder for describe image
+    application.add_handler(CommandHandler("profile", profile_command)) # Admins only
 
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(handle_post_generation_buttons, pattern=r'^(regenerate|start_new|save_current_settings|upscale_image)$'))
+    application.add_handler(CallbackQueryHandler(stop_generation, pattern=r'^stop_generation$'))
+    application.add_handler(CommandHandler("cancel", cancel)) # Also stops generations after the conversation ended
+
+    return application
+
+def run_application(application: Application) -> None:
+    """Receives updates via webhook if WEBHOOK_URL is set, otherwise via long polling."""
+    if WEBHOOK_URL:
+        logger.info(f"Receiving updates via webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32), # Requests without it are rejected
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
+def main() -> None:
+    """Starts the bot."""
+    if SHARD_COUNT > 1:
+        run_sharded()
+        return
+    application = build_application()
     logger.info("Bot started. Press Ctrl-C to stop.")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(application)
 
 if __name__ == "__main__":
     main()